@@ -8,6 +8,11 @@ __author__ = 'mm'
 #
 
 import sys
+import argparse
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import requests
 import logging
 from logging.handlers import RotatingFileHandler
@@ -16,24 +21,105 @@ import os
 import datetime
 import time
 import geojson
+import math
+import csv
 from pathlib import Path
 import json
 from flask import Flask, render_template
+from metobs_http import get_client
+import metobs_columnar
+import metobs_compress
+from metobs_files import atomic_open, replace_symlink, write_bytes, write_text
+from metobs_archive import Archive
+from metobs_manifest import Manifest
+from metobs_metrics import Metrics
+
+try:
+    import orjson  # Optional, a much faster JSON encoder than json
+except ImportError:
+    orjson = None
 
 
 app = Flask(__name__)
 
+MAX_CONCURRENCY = 32  # Max number of outstanding requests towards SMHI in total
+MAX_PER_HOST = 16     # Max number of outstanding requests per host
+MONITOR_INTERVAL = 5  # Seconds between reports of the queue of station tasks
+RESOLVE_CACHE = "resolve_cache.json"  # Cache of data links per station, stored next to this script
+RESOLVE_MAX_AGE = 24 * 3600           # Seconds before a cached data link is resolved again
+DUPLICATE_TOLERANCE = 0.0  # Degrees, stations closer than this to an already added station are duplicates
+SERIES_DIR = "series"  # Sub-directory of the day with observations of the day in incremental mode
+JOURNAL_DIR = "journal"            # Checkpoint journals of runs, stored next to this script
+JOURNAL_MAX_AGE = 7 * 24 * 3600   # Seconds before an old journal is removed
+BULK_PATH = "/station-set/all/period/latest-hour/data.json"  # Latest values of all stations, relative a resource
+METRICS_DIR = "metrics"  # Metrics of each run (JSON) and the Prometheus textfile, stored next to this script
+
+
+def is_number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool) and math.isfinite(x)
+
+
+def json_bytes(obj):
+    # obj as UTF-8 JSON, with orjson if available
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def write_json(fn, obj):
+    write_bytes(fn, json_bytes(obj))
+
+
+def write_compressed(fn, data, encodings, keep_plain=True):
+    # Write data to fn and the compressed variants of metobs_compress for encodings, e.g. fn.gz for 'gzip'. Variants of
+    # other encodings, from an earlier run, are removed. Without keep_plain only the compressed variants are kept
+    for encoding, ext in metobs_compress.EXTS.items():
+        if encoding in encodings:
+            write_bytes(fn + ext, metobs_compress.compress(data, encoding))
+        elif os.path.exists(fn + ext):
+            os.remove(fn + ext)
+    if keep_plain or not encodings:
+        write_bytes(fn, data)
+    elif os.path.exists(fn):
+        os.remove(fn)
+
+
+def write_columnar(fn, fc):
+    # Write fc in the columnar format of metobs_columnar, also via a temporary file
+    with atomic_open(fn, mode='wb') as outfile:
+        metobs_columnar.save(outfile, fc)
+
+
+def collector_metrics():
+    # Metrics of a collector run, see metobs_metrics. Labels: resource is the key, e.g. "01", hop is the step in the
+    # chain of the API: "resource" (station list), "station", "period", "data" or "bulk"
+    metrics = Metrics()
+    metrics.define("metobs_request_seconds", "histogram", "Latency of requests per API hop, including retries")
+    metrics.define("metobs_requests_total", "counter", "Number of requests per resource and API hop")
+    metrics.define("metobs_bytes_total", "counter", "Bytes downloaded per resource")
+    metrics.define("metobs_resource_seconds", "gauge", "Wall time to collect a resource")
+    metrics.define("metobs_build_seconds", "gauge", "Time to build (and validate) the FeatureCollection of a resource")
+    metrics.define("metobs_store_seconds", "gauge", "Time to write the files of a resource")
+    metrics.define("metobs_stations", "gauge", "Number of stations in the FeatureCollection of a resource")
+    metrics.define("metobs_stations_failed", "gauge", "Number of stations of a resource that could not be collected")
+    metrics.define("metobs_resources", "gauge", "Number of resources of the run, by status")
+    metrics.define("metobs_run_seconds", "gauge", "Wall time of the run")
+    metrics.define("metobs_run_timestamp_seconds", "gauge", "End of the run, seconds since epoch")
+    return metrics
+
 
 class SmhiReader(threading.Thread):
-    def __init__(self, smhi_inst, key):
+    def __init__(self, smhi_inst, key, on_result=None):
         threading.Thread.__init__(self)
         self.key = key
         self.smhi = smhi_inst
+        self.on_result = on_result
         self.result = {}
         self.start()
 
     def run(self):
-        self.result = {'fc': self.smhi.get(self.key), 'resource': self.key}
+        # Stations of this resource are fetched concurrently by the asyncio engine, in an event loop of this thread
+        self.result = self.smhi.get_all([self.key], on_result=self.on_result)[0]
 
     def get_data(self):
         return self.result
@@ -44,7 +130,7 @@ class Smhi:
         self.url = "http://opendata-download-metobs.smhi.se/api.json"  # Root for SMHI REST API
 
         try:
-            api = requests.get(self.url).json()
+            api = get_client().get_json(self.url)
 
             # The "next("... construct is used several times below to keep the code short
             # It is equivalent to:
@@ -55,7 +141,7 @@ class Smhi:
             # ind1 points to the latest version of SMHI api, ind2 to the json-type of the latest api
             ind1 = next(i for (i, d) in enumerate(api["version"]) if d["key"] == "latest")
             ind2 = next(i for (i, d) in enumerate(api["version"][ind1]["link"]) if d["type"] == "application/json")
-            self.resources = requests.get(api["version"][ind1]["link"][ind2]["href"]).json()
+            self.resources = get_client().get_json(api["version"][ind1]["link"][ind2]["href"])
         except requests.exceptions.RequestException as e:
             logger.error(e)
             sys.exit(1)
@@ -68,173 +154,663 @@ class Smhi:
                     'link': r['link'][0]['href']}
             self.keys.append(elem)
 
+        self.cache = None  # Optional ResolveCache, set by the caller
+        self.bulk = False  # If True, fetch all stations of a resource in one request, see AsyncCollector.bulk_observe
+        self.validate = False  # If True, validate features with geojson (slow, for debugging)
+        self.series_path = None  # Directory of the day in incremental mode, see SeriesStore
+        self.archive = None  # Optional metobs_archive.Archive, filled with all collected observations
+        self.journal = None  # Optional Journal, checkpoints of the run
+        self.metrics = collector_metrics()
+
+    def get(self, key):
+        # Collect one resource, stations are fetched concurrently by the asyncio engine
+        return self.get_all([key])[0].get('fc')
+
+    def get_all(self, keys, concurrency=MAX_CONCURRENCY, per_host=MAX_PER_HOST, on_result=None):
+        # Collect all resources in keys, returns a list of {'fc': ..., 'resource': ..., 'failed': [...]} in the same
+        # order as keys. 'failed' lists the stations that could not be collected, the FeatureCollection holds the rest
+        # {'resource': ..., 'error': "..."} is returned for a resource that failed
+        # If on_result is given, it is called with each result as soon as the resource is completed (e.g.
+        # DayStore.put), and the FeatureCollection is not kept in the returned list
+        return AsyncCollector(self, concurrency, per_host, on_result).run(keys)
+
+    @staticmethod
+    def json_index(links):
+        # Index of the first link with json content
+        return next(i for (i, d) in enumerate(links) if d["type"] == "application/json")
+
     @staticmethod
-    def get(key):
+    def latest_day_url(station):
+        # Link to the 'latest-day' period of a station, None if the station has no such period
+        ind = next((i for (i, d) in enumerate(station["period"]) if d["key"] == "latest-day"), None)
+        if ind is None:
+            return None
+        period = station["period"][ind]
+        return period["link"][Smhi.json_index(period["link"])]["href"]
+
+    @staticmethod
+    def data_url(period):
+        # Note, no key for data, hence always 0
+        return period["data"][0]["link"][Smhi.json_index(period["link"])]["href"]
+
+    @staticmethod
+    def feature(key, stn, val):
+        # A GeoJSON Point feature as a plain dict, None if coordinates or properties fail the checks below.
+        # The checks are cheap type and range checks, full geojson validation is done in feature_collection if asked
+        lon, lat = stn["longitude"], stn["latitude"]
+        if not (is_number(lon) and is_number(lat) and -180.0 <= lon <= 180.0 and -90.0 <= lat <= 90.0):
+            return None
+        if not (is_number(val) or isinstance(val, str)) or not isinstance(stn["updated"], int):
+            return None
+        if stn["height"] is not None and not is_number(stn["height"]):
+            return None
+
+        s, ms = divmod(stn["updated"], 1000)
+        ts = '{}.{:03d}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(s)), ms)
+        return {"type": "Feature",
+                "id": stn["name"],
+                "geometry": {"type": "Point", "coordinates": [round(lon, 6), round(lat, 6)]},
+                "properties": {"key": key["key"],
+                               "title": key['title'],
+                               "summary": key["summary"],
+                               "updated": stn["updated"],
+                               "timestamp": ts,
+                               "height": stn["height"],
+                               "value": val}}
+
+    @staticmethod
+    def feature_collection(key, observations, tolerance=DUPLICATE_TOLERANCE, validate=False):
+        # observations is a list of (station, data) tuples in station order, data is None for stations without
+        # a 'latest-day' period. Returns a FeatureCollection as a plain dict, or None if validate is True and
+        # geojson finds it not valid
+        lst = []
+        index = CoordIndex(tolerance)
+        for stn, lnk in observations:
+            if lnk is not None and lnk["value"] is not None and lnk["value"] and stn['active'] is True:
+                try:
+                    # NB if we take the last element we get the latest value,
+                    # the first element (0) is the oldest, the last is the youngest (in case we have a list)
+                    val = float(lnk["value"][-1]["value"])
+                except ValueError:
+                    # There is a value that cannot be converted to float (e.g. "regn", store it as text
+                    val = lnk["value"][-1]["value"]
+
+                # avoid duplicates
+                duplicate = index.find(stn["longitude"], stn["latitude"])
+                if duplicate is None:
+                    feature = Smhi.feature(key, stn, val)
+                    if feature is None:
+                        logger.info("Feature not valid: {}".format(stn["name"]))
+                    elif validate and not geojson.GeoJSON.to_instance(feature).is_valid:
+                        logger.info("Feature not valid: {} - {}".format(
+                            stn["name"], geojson.GeoJSON.to_instance(feature).errors()))
+                    else:
+                        lst.append(feature)
+                        index.add(stn["longitude"], stn["latitude"], stn["name"])
+                else:
+                    index.collisions.append((stn["name"], duplicate))
+                    logger.info("{}: found point long: {}, lat: {}, station {} duplicates {}".format(key['title'],
+                                                                                                stn["longitude"],
+                                                                                                stn["latitude"],
+                                                                                                stn["name"],
+                                                                                                duplicate))
+        fc = {"type": "FeatureCollection", "features": lst}
+        if validate and not geojson.FeatureCollection(lst).is_valid:
+            logger.info("Feature Collection not valid: {} - {}".format(key['title'] + " (" + key['summary'] + ")",
+                                                                       geojson.FeatureCollection(lst).errors()))
+            return None
+        else:
+            logger.info("Exiting {}, no of stations: {}, duplicates: {}".format(key['title'], len(lst),
+                                                                               len(index.collisions)))
+            return fc
+
+
+class CoordIndex:
+    # Hashed index of station coordinates for duplicate detection in constant time.
+    # With tolerance 0 coordinates must be equal (at the 6 decimals kept by geojson), otherwise coordinates are snapped
+    # to a grid of cells with side tolerance and the neighbouring cells are searched for a station within tolerance.
+    def __init__(self, tolerance=0.0):
+        self.tolerance = tolerance
+        self.cells = {}
+        self.collisions = []  # List of (station, duplicated station)
+
+    def _cell(self, lon, lat):
+        if self.tolerance > 0:
+            return int(lon // self.tolerance), int(lat // self.tolerance)
+        return round(lon, 6), round(lat, 6)
+
+    def find(self, lon, lat):
+        # Returns the id of a station at (lon, lat), None if there is no such station
+        if self.tolerance <= 0:
+            entry = self.cells.get(self._cell(lon, lat))
+            return entry[0][2] if entry else None
+
+        cx, cy = self._cell(lon, lat)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for x, y, stn_id in self.cells.get((cx + dx, cy + dy), []):
+                    if abs(x - lon) <= self.tolerance and abs(y - lat) <= self.tolerance:
+                        return stn_id
+        return None
+
+    def add(self, lon, lat, stn_id):
+        self.cells.setdefault(self._cell(lon, lat), []).append((lon, lat, stn_id))
+
+
+class AsyncCollector:
+    # Collects resources with asyncio at station level. Concurrency is bounded by a global limit and a limit per host.
+    # The blocking requests are executed in a thread pool, sized to the global limit.
+    # The stations of all resources are put as tasks on one shared queue, served by a fixed number of workers (the
+    # global limit). An idle worker takes the next station of any resource, so no worker waits while a resource with
+    # many stations is collected. Resources with few stations are served first, they are completed (and stored) early.
+    def __init__(self, smhi_inst, concurrency=MAX_CONCURRENCY, per_host=MAX_PER_HOST, on_result=None):
+        self.smhi = smhi_inst
+        self.cache = smhi_inst.cache
+        self.journal = smhi_inst.journal
+        self.metrics = smhi_inst.metrics
+        self.on_result = on_result
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.semaphore = None
+        self.host_semaphores = {}
+        self.executor = None
+        self.queue = None
+        self.seq = itertools.count()  # Tie breaker in the queue, keeps station order within a resource
+        self.start = 0
+        self.busy = 0       # Number of workers busy with a task
+        self.tasks = 0      # Number of tasks done
+        self.max_depth = 0  # Max number of tasks in the queue
+
+    def run(self, keys):
+        return asyncio.run(self._run(keys))
+
+    async def _run(self, keys):
+        # Semaphores and queue must be created within the running event loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.host_semaphores = {}
+        self.queue = asyncio.PriorityQueue()
+        self.start = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self.executor:
+            workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+            workers.append(asyncio.create_task(self.monitor()))
+            try:
+                return await asyncio.gather(*[self._get(key) for key in keys])
+            finally:
+                for w in workers:
+                    w.cancel()
+                logger.info("Scheduler: {} workers, {} station tasks, max queue depth {}, {:.1f}s".format(
+                    self.concurrency, self.tasks, self.max_depth, time.time() - self.start))
+
+    async def worker(self):
+        while True:
+            _, _, key, stn, series, future = await self.queue.get()
+            if future.cancelled():
+                continue  # The resource has already failed
+            self.busy += 1
+            try:
+                result = await self.checkpointed_observe(key, stn, series)
+                if not future.cancelled():
+                    future.set_result(result)
+            except Exception as e:  # Handed over to the resource waiting for the station
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.busy -= 1
+                self.tasks += 1
+
+    async def monitor(self):
+        # Report the queue depth and busy workers, to help sizing the number of workers
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL)
+            if self.queue.qsize() or self.busy:
+                logger.info("Queue depth {}, busy workers {} of {}, {} tasks done".format(
+                    self.queue.qsize(), self.busy, self.concurrency, self.tasks))
+
+    async def schedule(self, key, stations, series):
+        # Put one task per station on the shared queue, returns the results in station order
+        # The result of a failed station is its exception
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in stations]
+        for stn, future in zip(stations, futures):
+            self.queue.put_nowait((len(stations), next(self.seq), key, stn, series, future))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    def get_json(self, url, key, hop):
+        # Blocking request, executed in the thread pool. Counted in the metrics of resource key and API hop
+        start = time.time()
+        r = get_client().get(url)
+        self.metrics.observe("metobs_request_seconds", time.time() - start, hop=hop)
+        self.metrics.inc("metobs_requests_total", resource=key['key'], hop=hop)
+        self.metrics.inc("metobs_bytes_total", len(r.content), resource=key['key'])
+        r.raise_for_status()
+        return r.json()
+
+    async def fetch(self, url, key, hop):
+        host = urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.per_host)
+
+        async with self.host_semaphores[host]:
+            async with self.semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, self.get_json, url, key, hop)
+
+    async def resolve(self, key, stn):
+        # Follow the chain station -> 'latest-day' period -> data listing, returns the data link or None
+        lnk = await self.fetch(stn["link"][Smhi.json_index(stn["link"])]["href"], key, "station")
+        url = Smhi.latest_day_url(lnk)
+        if url is None:
+            return None
+        period = await self.fetch(url, key, "period")
+        return Smhi.data_url(period)
+
+    async def observe(self, key, stn, series=None):
+        # Get the latest data for one station, one request if the data link is cached, otherwise four
+        if stn['active'] is not True:
+            return None  # Inactive stations are never part of the result, no need to fetch anything
+        if series is not None and series.unchanged(stn):
+            return series.latest(stn)  # No new data since the last run, no need to fetch anything
+
+        hit, url = self.cache.lookup(key, stn) if self.cache else (False, None)
+        if hit:
+            if url is None:
+                return None  # Known to have no 'latest-day' period
+            try:
+                data = await self.fetch(url, key, "data")
+                if "value" in data:
+                    return data
+            except (requests.exceptions.HTTPError, json.decoder.JSONDecodeError):
+                pass
+            logger.info("{}: stale data link for station {}, resolving".format(key['title'], stn['key']))
+
+        url = await self.resolve(key, stn)
+        if self.cache:
+            self.cache.update(key, stn, url)
+        return None if url is None else await self.fetch(url, key, "data")
+
+    async def checkpointed_observe(self, key, stn, series=None):
+        # observe, but a station completed in an earlier attempt of the run is taken from the journal
+        if self.journal is not None:
+            hit, data = self.journal.station(key, stn)
+            if hit:
+                return data
+        data = await self.observe(key, stn, series)
+        if self.journal is not None:
+            self.journal.station_done(key, stn, data)
+        return data
+
+    async def bulk_observe(self, key):
+        # One request for the latest hour of all stations of a resource ('station-set/all'). Returns a list of
+        # (station, data) tuples like observe, or None if the resource has no such data set (e.g. daily values).
+        if not key['link'].endswith(".json"):
+            return None
+        try:
+            data = await self.fetch(key['link'][:-len(".json")] + BULK_PATH, key, "bulk")
+        except (requests.exceptions.HTTPError, json.decoder.JSONDecodeError) as e:
+            logger.info("{}: no bulk data ({}), using per station requests".format(key['title'], e))
+            return None
+
+        observations = []
+        for stn in data.get("station", []):
+            if stn.get("value"):
+                # The station set only includes stations with data, and has no 'updated' field per station
+                stn = dict(stn, active=True, updated=stn.get("updated", stn["value"][-1]["date"]))
+                observations.append((stn, {"value": stn["value"]}))
+        return observations
+
+    async def _get(self, key):
+        if self.journal is not None and self.journal.is_done(key):
+            logger.info("{}: done in an earlier attempt of the run".format(key['title']))
+            return {'resource': key}
+
         logger.info("Starting {}".format(key['title'] + " (" + key['summary'] + ")"))
+        start = time.time()
+        failed = []
+        loop = asyncio.get_running_loop()
         try:
-            # Try to get the indicated resource from the SMHI latest api (setup at initialization)
-            stations = requests.get(key['link']).json()
-            lst = []
-            for i, stn in enumerate(stations["station"]):
-                ind1 = next(i for (i, d) in enumerate(stn["link"]) if d["type"] == "application/json")
-                lnk = requests.get(stn["link"][ind1]["href"]).json()
-                ind2 = next((i for (i, d) in enumerate(lnk["period"]) if d["key"] == "latest-day"), None)
-                if ind2 is not None:
-                    lnk = lnk["period"][ind2]
-                    ind3 = next(i for (i, d) in enumerate(lnk["link"]) if d["type"] == "application/json")
-                    lnk = requests.get(lnk["link"][ind3]["href"]).json()
-                    ind4 = next(i for (i, d) in enumerate(lnk["link"]) if d["type"] == "application/json")
-                    # Note, no key for data, hence always 0
-                    lnk = requests.get(lnk["data"][0]["link"][ind4]["href"]).json()
-                    if lnk["value"] is not None and lnk["value"] and stn['active'] is True:
-                        try:
-                            # NB if we take the last element we get the latest value,
-                            # the first element (0) is the oldest, the last is the youngest (in case we have a list)
-                            val = float(lnk["value"][-1]["value"])
-                        except ValueError:
-                            # There is a value that cannot be converted to float (e.g. "regn", store it as text
-                            val = lnk["value"][-1]["value"]
-
-                        # avoid duplicates
-                        if (stn["longitude"], stn["latitude"]) not in list(geojson.utils.coords(lst)):
-                            point = geojson.Point((stn["longitude"], stn["latitude"]))
-                            s, ms = divmod(stn["updated"], 1000)
-                            ts = '{}.{:03d}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(s)), ms)
-                            feature = geojson.Feature(geometry=point,
-                                                      properties={"key": key["key"],
-                                                                  "title": key['title'],
-                                                                  "summary": key["summary"],
-                                                                  "updated": stn["updated"],
-                                                                  "timestamp": ts,
-                                                                  "height": stn["height"],
-                                                                  "value": val},
-                                                      id=stn["name"])
-                            if not feature.is_valid:
-                                logger.info("Feature not valid: {} - {}".format(stn["name"], feature.errors()))
-                            else:
-                                lst.append(feature)
-                        else:
-                            logger.info("{}: found point long: {}, lat: {}".format(key['title'],
-                                                                                   stn["longitude"],
-                                                                                   stn["latitude"]))
-            fc = geojson.FeatureCollection(lst)
-            if not fc.is_valid:
-                logger.info("Feature Collection not valid: {} - {}".format(key['title'] + " (" + key['summary'] + ")",
-                                                                           fc.errors()))
-                return None
-            else:
-                logger.info("Exiting {}, no of stations: {}".format(key['title'], len(lst)))
-                return fc
-
-        except (requests.exceptions.RequestException, json.decoder.JSONDecodeError) as e:
-            logger.error(e)
-            sys.exit(1)
+            # Reading and writing the series and the archive is file I/O, done in the thread pool so the workers are
+            # not blocked
+            series = await loop.run_in_executor(self.executor, SeriesStore, self.smhi.series_path, key) \
+                if self.smhi.series_path else None
+            observations = await self.bulk_observe(key) if self.smhi.bulk else None
+            mode = "bulk"
+            if observations is None:
+                # Try to get the indicated resource from the SMHI latest api (setup at initialization)
+                mode = "station"
+                stations = (await self.fetch(key['link'], key, "resource"))["station"]
+                if self.cache:
+                    self.cache.prune(key, stations)
+                data = await self.schedule(key, stations, series)
+                failed = [stn for stn, d in zip(stations, data) if isinstance(d, Exception)]
+                if failed and len(failed) == len([stn for stn in stations if stn['active'] is True]):
+                    raise data[stations.index(failed[0])]  # Nothing to publish
+                for stn in failed:
+                    logger.error("{}: station {} failed: {}".format(key['title'], stn['name'],
+                                                                    data[stations.index(stn)]))
+                observations = [(stn, None if isinstance(d, Exception) else d) for stn, d in zip(stations, data)]
+
+            if series is not None:
+                nr = await loop.run_in_executor(self.executor, series.append, observations)
+                logger.info("{}: {} new observations".format(key['title'], nr))
+            if self.smhi.archive is not None:
+                rows = [(stn["name"], v["date"], v["value"]) for stn, data in observations
+                        if data is not None and data["value"] and stn['active'] is True for v in data["value"]]
+                nr = await loop.run_in_executor(self.executor, self.smhi.archive.append, key['key'], rows)
+                logger.info("{}: {} records archived".format(key['title'], nr))
+
+            with self.metrics.timer("metobs_build_seconds", resource=key['key']):
+                fc = Smhi.feature_collection(key, observations, validate=self.smhi.validate)
+            logger.info("{}: collected in {:.2f}s ({}), completed {:.2f}s after start".format(
+                key['title'], time.time() - start, mode, time.time() - self.start))
+            self.metrics.set("metobs_resource_seconds", time.time() - start, resource=key['key'])
+            self.metrics.set("metobs_stations_failed", len(failed), resource=key['key'])
+            if fc is None:
+                return {'resource': key, 'error': "FeatureCollection not valid"}
+            self.metrics.set("metobs_stations", len(fc['features']), resource=key['key'])
+            result = {'fc': fc, 'resource': key, 'failed': [stn['name'] for stn in failed]}
+            if self.on_result is not None:
+                await loop.run_in_executor(self.executor, self.on_result, result)
+                result = {'resource': key, 'failed': result['failed']}  # Stored, no need to keep the FeatureCollection
+            if self.journal is not None and not failed:
+                self.journal.resource_done(key)
+            return result
+        except Exception as e:
+            logger.error("{}: {}".format(key['title'], e))
+            self.metrics.set("metobs_resource_seconds", time.time() - start, resource=key['key'])
+            return {'resource': key, 'error': str(e)}
+
+
+class SeriesStore:
+    # Observations of one resource during a day, used by the incremental mode. Stored as an append-only csv-file,
+    # ROOT/2020/06/21/series/01.csv, with the rows: station,updated,date,value
+    # 'station' is the station id, 'updated' the station's 'updated' when collected and 'date' the time of observation.
+    # Only observations newer than the last stored for a station are appended. When a station's 'updated' changes
+    # without a newer observation a marker row is appended, with empty date and value, to record the new 'updated'.
+    # A station with the same 'updated' as in its last row has no new data and need not be fetched.
+    def __init__(self, path, key):
+        self.fn = os.path.join(path, SERIES_DIR, key['key'] + ".csv")
+        self.last = {}  # station: (updated, date, value) from the last row of each station
+        try:
+            with open(self.fn, encoding='utf-8', newline='') as f:
+                for row in csv.DictReader(f):
+                    if row['date']:
+                        self.last[row['station']] = (int(row['updated']), int(row['date']), row['value'])
+                    elif row['station'] in self.last:  # Marker row
+                        self.last[row['station']] = (int(row['updated']),) + self.last[row['station']][1:]
+        except FileNotFoundError:
+            pass
+
+    def unchanged(self, stn):
+        last = self.last.get(str(stn['key']))
+        return last is not None and last[0] == stn['updated']
+
+    def latest(self, stn):
+        # The last stored observation, in the format of the SMHI data
+        _, date, value = self.last[str(stn['key'])]
+        return {"value": [{"date": date, "value": value}]}
+
+    def append(self, observations):
+        # Append new values in observations, a list of (station, data) tuples, returns the number of new observations
+        rows = []
+        for stn, data in observations:
+            if data is None or stn['active'] is not True:
+                continue
+            station = str(stn['key'])
+            last_date = self.last[station][1] if station in self.last else -1
+            for v in data.get("value") or []:
+                if v["date"] > last_date:
+                    rows.append((station, stn['updated'], v["date"], v["value"]))
+                    self.last[station] = (stn['updated'], v["date"], v["value"])
+                    last_date = v["date"]
+            if station in self.last and self.last[station][0] != stn['updated']:
+                rows.append((station, stn['updated'], "", ""))
+                self.last[station] = (stn['updated'],) + self.last[station][1:]
+
+        if rows:
+            Path(os.path.dirname(self.fn)).mkdir(parents=True, exist_ok=True)
+            new_file = not os.path.exists(self.fn)
+            with open(self.fn, encoding='utf-8', mode='a', newline='') as outfile:
+                writer = csv.writer(outfile)
+                if new_file:
+                    writer.writerow(("station", "updated", "date", "value"))
+                writer.writerows(rows)
+        return sum(1 for row in rows if row[2] != "")
+
+
+class Journal:
+    # Checkpoint journal of a run, JOURNAL_DIR/2020062113.jsonl, one JSON object per line:
+    # {"station": "01/159880", "data": {...}} for each collected station
+    # {"resource": "01"} for each resource collected without failures, and stored
+    # A run started with the id of an interrupted (or partially failed) run resumes it, only the stations and resources
+    # not in the journal are collected. The journal is removed when a run completes without failures.
+    def __init__(self, run_id):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), JOURNAL_DIR)
+        Path(path).mkdir(parents=True, exist_ok=True)
+        for fn in os.listdir(path):
+            if time.time() - os.path.getmtime(os.path.join(path, fn)) > JOURNAL_MAX_AGE:
+                os.remove(os.path.join(path, fn))
+
+        self.fn = os.path.join(path, run_id + ".jsonl")
+        self.lock = threading.Lock()
+        self.stations = {}
+        self.resources = set()
+        try:
+            with open(self.fn, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        continue  # Last line of an interrupted run might be incomplete
+                    if 'station' in entry:
+                        self.stations[entry['station']] = entry['data']
+                    elif 'resource' in entry:
+                        self.resources.add(entry['resource'])
+            logger.info("Resuming run {}: {} stations and {} resources done".format(run_id, len(self.stations),
+                                                                                     len(self.resources)))
+        except FileNotFoundError:
+            pass
+        self.outfile = open(self.fn, encoding='utf-8', mode='a')
 
+    @staticmethod
+    def _id(key, stn):
+        return key['key'] + "/" + str(stn['key'])
+
+    def _write(self, entry):
+        with self.lock:
+            self.outfile.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.outfile.flush()
+
+    def station(self, key, stn):
+        # Returns (hit, data) for a station collected in an earlier attempt
+        station_id = self._id(key, stn)
+        return (True, self.stations[station_id]) if station_id in self.stations else (False, None)
+
+    def station_done(self, key, stn, data):
+        self.stations[self._id(key, stn)] = data
+        self._write({'station': self._id(key, stn), 'data': data})
+
+    def is_done(self, key):
+        return key['key'] in self.resources
+
+    def resource_done(self, key):
+        self.resources.add(key['key'])
+        self._write({'resource': key['key']})
+
+    def close(self, remove=False):
+        self.outfile.close()
+        if remove:
+            os.remove(self.fn)
+
+
+class ResolveCache:
+    # Persistent cache of the data link for each (parameter key, station id). Only the last hop of the chain in
+    # AsyncCollector.resolve changes between runs, so with a warm cache each station costs one request.
+    # Entries are resolved again when older than max_age or when the cached link fails, and evicted when the station
+    # disappears from the station list or becomes inactive.
+    def __init__(self, fn=RESOLVE_CACHE, max_age=RESOLVE_MAX_AGE):
+        self.fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), fn)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.fn, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            self.entries = {}
 
-ROOT = "metobs_data/"
-INDEX_HTML = "index.html"
+    @staticmethod
+    def _id(key, stn):
+        return key['key'] + "/" + str(stn['key'])
+
+    def lookup(self, key, stn):
+        # Returns (hit, url), url is None for a station known to lack a 'latest-day' period
+        with self.lock:
+            entry = self.entries.get(self._id(key, stn))
+            if entry is not None and time.time() - entry['resolved'] < self.max_age:
+                self.hits += 1
+                return True, entry['url']
+            self.misses += 1
+            return False, None
+
+    def update(self, key, stn, url):
+        with self.lock:
+            self.entries[self._id(key, stn)] = {'url': url, 'resolved': time.time()}
+
+    def prune(self, key, stations):
+        # Evict entries for stations of this resource that are gone or inactive
+        prefix = key['key'] + "/"
+        active = {self._id(key, stn) for stn in stations if stn['active'] is True}
+        with self.lock:
+            for k in [k for k in self.entries if k.startswith(prefix) and k not in active]:
+                del self.entries[k]
+
+    def save(self):
+        with self.lock:
+            with atomic_open(self.fn) as outfile:
+                json.dump(fp=outfile, obj=self.entries)
+        logger.info("Resolve cache: {} hits, {} misses, {} entries".format(self.hits, self.misses, len(self.entries)))
 
 
-def init_row():
-    row = {}
-    for i in range(1, 13):
-        row["{:02d}".format(i)] = {'path': '', 'str': ''}
-    return row
+ROOT = "metobs_data/"
+INDEX_HTML = "index.html"
 
 
-def store(lst):
+class DayStore:
     """
-    Create a file "ROOT/2020/06/21/XXX.geojson" and a meta-data file "ROOT/2020/06/21/meta.json"
+    Stores resources in the directory of the day, "ROOT/2020/06/21", as they are completed
+    put() creates a file "ROOT/2020/06/21/XXX.geojson", compressed variants "XXX.geojson.gz" and/or "XXX.geojson.zst"
+    (see metobs_compress, the plain file is optional), a columnar companion "ROOT/2020/06/21/XXX.npz" (see
+    metobs_columnar) and updates the meta-data file "ROOT/2020/06/21/meta.json"
     meta.json includes a summary and a translation from "3" (key) to "title" and "summary"
-    Then create an index.html file, with a list of all geojson-files created
-    Also create a top-level index.html to navigate in the directory structure
-    Finally create a symbolic link 'latest', pointing at the new directory
+    Stations that failed are listed in the translation of the resource ('failed'), resources that failed in 'failed'
+    After the first put() the symbolic link 'latest' points at the directory, so new files are published immediately
+    finish() creates an index.html file, with a list of all geojson-files in the directory and a top-level
+    index.html to navigate in the directory structure, see metobs_manifest
+    All files are written to a temporary file first and then renamed, readers never see a partial file
     """
-    os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
-    now = datetime.datetime.now()
-    year = now.strftime("%Y")
-    month = now.strftime("%m")
-    day = now.strftime("%d")
-    path = os.path.join(ROOT, year, month, day)
-    Path(path).mkdir(parents=True, exist_ok=True)
-
-    nr_res = 0  # Keep track of number of resource files generated, written into the meta-data file
-    key_translations = {}  # Keep a dictionary of 'key': 'title': 'ABC', 'summary' 'DEF'
-    for k, v in lst.items():
-        nr_res += 1
-        key_translations[k] = {'resource': v['resource']}
-        title = v['resource']['title'].replace(" ", "_").replace(",", "").replace("/", "_per_")
-        summary = v['resource']['summary'].replace(" ", "_").replace(",", "").replace("/", "_per_")
-        res_name = os.path.join(path, k + "_" + title + "__" + summary + ".geojson")
-        with open(res_name, encoding='utf-8', mode='w') as outfile:
-            geojson.dump(fp=outfile, obj=v['fc'], ensure_ascii=False)
-            outfile.close()
-
-    meta_name = os.path.join(path, "meta.json")
-    with open(meta_name, encoding='utf-8', mode='w') as outfile:
-        json.dump(fp=outfile,
-                  obj={"generated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                       "resources": str(nr_res),
-                       "translations": key_translations},
-                  ensure_ascii=False)
-        outfile.close()
-
-    # Now generate index.html in each directory, this is a HTML list of geojson-files generated
-    index_name = os.path.join(path, INDEX_HTML)
-    with app.app_context():
-        files = [name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name))]
-        geojson_files = sorted([name for name in files if name.endswith(".geojson")])
-        index_file = render_template('geojson_index.html',
-                                     title=path[len(ROOT):].replace("/", "-"),
-                                     files=geojson_files)
-        with open(index_name, encoding='utf-8', mode='w') as outfile:
-            outfile.write(index_file)
-
-        table = {}
-        # Look recursively for index.html files from ROOT and downwards
-        for path in Path(ROOT).rglob(INDEX_HTML):
-            # Avoid ROOT/index.html file, only those in sub-directories is valid
-            if os.path.join(ROOT, INDEX_HTML) != str(path):
-                parent_path = str(path.parent)[len(ROOT):]  # Skip ROOT from parent_path
-
-                # First get the components from parent_path; 2020/06/23
-                table_year = parent_path.split(os.path.sep)[0]   # 2020
-                table_month = parent_path.split(os.path.sep)[1]  # 06
-                table_day = parent_path.split(os.path.sep)[2]    # 23
-
-                # result2 = {'2020': {'23': {'01': {'path': "", 'str': ""},
-                #                            '02': {'path': "", 'str': ""},
-                #                             ...
-                #                            '06': {'path': "2020/06/23", 'str': "23"},
-                #                            '07': {'path': "", 'str': ""},
-                #                             ...
-                #                            '12': {'path': "", 'str: ""}
-                #                    }
-                #           }
-                if table_year not in table:
-                    day_row = init_row()
-                    day_row[table_month] = {'path': str(parent_path), 'str': table_day}
-                    table[table_year] = {table_day: day_row}
-                else:
-                    if table_day not in table[table_year]:
-                        # day_row = init_row()
-                        table[table_year][table_day] = init_row()
+    def __init__(self, metrics=None):
+        os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+        self.metrics = collector_metrics() if metrics is None else metrics  # Write time of each resource
+        self.encodings = ['gzip']  # Compressed variants written by put(), see metobs_compress
+        self.keep_plain = True     # If False, only the compressed variants are kept
+        now = datetime.datetime.now()
+        self.year = now.strftime("%Y")
+        self.month = now.strftime("%m")
+        self.day = now.strftime("%d")
+        self.path = os.path.join(ROOT, self.year, self.month, self.day)
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.published = False
+        self.meta_name = os.path.join(self.path, "meta.json")
+        try:
+            # Keep translations of resources stored earlier the same day, their files are still in the directory
+            with open(self.meta_name, encoding='utf-8') as f:
+                meta = json.load(f)
+            self.key_translations = meta['translations']
+            self.failed = meta.get('failed', {})
+        except (OSError, KeyError, json.decoder.JSONDecodeError):
+            self.key_translations = {}  # Keep a dictionary of 'key': 'title': 'ABC', 'summary' 'DEF'
+            self.failed = {}  # 'key': 'error' for resources that failed
 
-                    table[table_year][table_day][table_month] = {'path': str(parent_path), 'str': table_day}
-                    # day_row[table_month] = {'path': str(parent_path), 'str': table_day}
-                    # table[table_year][table_day] = day_row
+    @staticmethod
+    def file_name(resource):
+        title = resource['title'].replace(" ", "_").replace(",", "").replace("/", "_per_")
+        summary = resource['summary'].replace(" ", "_").replace(",", "").replace("/", "_per_")
+        return resource['key'] + "_" + title + "__" + summary + ".geojson"
+
+    def put(self, result):
+        # Store one result, {'fc': ..., 'resource': ...}, from the collector
+        k = result['resource']['key']
+        res_name = os.path.join(self.path, self.file_name(result['resource']))
+        with self.metrics.timer("metobs_store_seconds", resource=k):
+            write_compressed(res_name, json_bytes(result['fc']), self.encodings, self.keep_plain)
+            write_columnar(res_name[:-len(".geojson")] + metobs_columnar.EXT, result['fc'])
+
+        with self.lock:
+            self.key_translations[k] = {'resource': result['resource']}
+            if result.get('failed'):
+                self.key_translations[k]['failed'] = result['failed']  # Partial result
+            self.failed.pop(k, None)
+            self.write_meta()
+            if not self.published:
+                self.publish()
+                self.published = True
+        logger.info("Stored {}".format(result['resource']['title']))
+
+    def fail(self, resource, error):
+        # Mark a resource as failed in meta.json, a file stored earlier the same day is kept
+        with self.lock:
+            self.failed[resource['key']] = error
+            self.write_meta()
+
+    def write_meta(self):
+        meta = {"generated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "resources": str(len(self.key_translations)),
+                "translations": self.key_translations}
+        if self.failed:
+            meta["failed"] = self.failed
+        write_json(self.meta_name, meta)
+
+    def publish(self):
+        # Create a symbolic link to the directory of the day in the ROOT directory, replaced atomically
+        latest_path = os.path.join(self.year, self.month, self.day)
+        replace_symlink(latest_path, os.path.join(ROOT, 'latest'))
+
+    def finish(self):
+        # Now generate index.html in each directory, this is a HTML list of geojson-files generated
+        index_name = os.path.join(self.path, INDEX_HTML)
+        with app.app_context():
+            # One link per resource, to the plain file or, with --compressed-only, to its first compressed variant
+            files = {name for name in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, name))}
+            geojson_files = []
+            for plain in sorted({metobs_compress.split(name)[0] for name in files}):
+                if plain.endswith(".geojson"):
+                    variants = [plain] + [plain + ext for ext in metobs_compress.EXTS.values()]
+                    geojson_files.append(next(name for name in variants if name in files))
+            index_file = render_template('geojson_index.html',
+                                         title=self.path[len(ROOT):].replace("/", "-"),
+                                         files=geojson_files)
+            write_text(index_name, index_file)
+
+            # Add the day to the manifest and re-render the section of its year, then the top-level index.html
+            manifest = Manifest(ROOT)
+            manifest.add(self.path[len(ROOT):].replace(os.sep, "/"), self.key_translations.keys())
+            manifest.render_root()
+
+        if not self.published:
+            self.publish()
+            self.published = True
 
-        root_index_file = render_template('geojson_root_index.html', files=table)
-        with open(os.path.join(ROOT, INDEX_HTML), encoding='utf-8', mode='w') as outfile:
-            outfile.write(root_index_file)
 
-        # Create a symbolic link to the latest generated directory in the ROOT directory
-        latest_path = os.path.join(year, month, day)
-        try:
-            os.symlink(latest_path, os.path.join(ROOT, 'latest'))
-        except FileExistsError:
-            os.remove(os.path.join(ROOT, 'latest'))
-            os.symlink(latest_path, os.path.join(ROOT, 'latest'))
+def store(lst):
+    # Store all results in lst, {'01': {'fc': ..., 'resource': ...}, ...}, in one go
+    day_store = DayStore()
+    for v in lst.values():
+        day_store.put(v)
+    day_store.finish()
 
 
 if __name__ == "__main__":
@@ -253,23 +829,93 @@ if __name__ == "__main__":
     logger.addHandler(fh)
     logger.addHandler(ch)
 
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-e", "--engine", required=False, default="asyncio", choices=["asyncio", "threads"],
+                    help="collection engine, 'threads' runs one thread per resource")
+    ap.add_argument("-c", "--concurrency", required=False, type=int, default=MAX_CONCURRENCY,
+                    help="max number of outstanding requests in total, also the number of workers")
+    ap.add_argument("-p", "--per-host", required=False, type=int, default=MAX_PER_HOST,
+                    help="max number of outstanding requests per host")
+    ap.add_argument("-n", "--no-cache", required=False, action="store_true",
+                    help="do not use the cache of resolved station data links")
+    ap.add_argument("-v", "--validate", required=False, action="store_true",
+                    help="validate all features with geojson (slow, for debugging)")
+    ap.add_argument("-b", "--bulk", required=False, action="store_true",
+                    help="fetch all stations of a resource in one request, per station requests as fallback")
+    ap.add_argument("-r", "--no-archive", required=False, action="store_true",
+                    help="do not add the observations to the long-term archive, see metobs_archive")
+    ap.add_argument("-j", "--run-id", required=False, default=datetime.datetime.now().strftime("%Y%m%d%H"),
+                    help="id of the run, default is the hour. Using the id of an interrupted run resumes it")
+    ap.add_argument("-k", "--no-journal", required=False, action="store_true",
+                    help="do not keep a checkpoint journal of the run")
+    ap.add_argument("-i", "--incremental", required=False, action="store_true",
+                    help="append new observations to the series of the day, only fetch stations with new data")
+    ap.add_argument("-z", "--compress", required=False, default="gzip", choices=["none", "gzip", "zstd", "all"],
+                    help="compressed variants of the stored GeoJSON files, zstd needs the package zstandard")
+    ap.add_argument("-o", "--compressed-only", required=False, action="store_true",
+                    help="store only the compressed variants, not the plain GeoJSON files")
+    ap.add_argument("-m", "--metrics-dir", required=False, default=METRICS_DIR,
+                    help="directory of the metrics of the run, JSON and Prometheus textfile")
+    args = vars(ap.parse_args())
+
     logger.info("Start")
+    get_client(pool_size=args['per_host'])  # Size the pool of connections to the workers per host
     smhi = Smhi()  # One instance, will populate "keys" at initialization
-
-    threads = []
-    for k in smhi.keys:
-        threads.append(SmhiReader(smhi, k))  # Will start a thread for this key (resource)
-
-    for t in threads:
-        t.join()  # Wait for all reading threads to terminate
-
-    weather_data = {}
-    ind = 0
-    for k in smhi.keys:
-        result = threads[ind].get_data()
-        if result:  # Could be None if there has been an error
-            weather_data[k['key']] = threads[ind].get_data()
-        ind += 1
-
-    store(weather_data)
+    if not args['no_cache']:
+        smhi.cache = ResolveCache()
+    smhi.bulk = args['bulk']
+    smhi.validate = args['validate']
+
+    start_time = time.time()
+    day_store = DayStore(smhi.metrics)  # Each resource is stored as soon as it is completed
+    encodings = list(metobs_compress.EXTS) if args['compress'] == "all" else \
+        [] if args['compress'] == "none" else [args['compress']]
+    for encoding in encodings:
+        if not metobs_compress.available(encoding):
+            logger.warning("{} is not available, install the package zstandard".format(encoding))
+    day_store.encodings = [encoding for encoding in encodings if metobs_compress.available(encoding)]
+    day_store.keep_plain = not args['compressed_only']
+    if args['incremental']:
+        smhi.series_path = day_store.path
+    if not args['no_archive']:
+        smhi.archive = Archive()
+    if not args['no_journal']:
+        smhi.journal = Journal(args['run_id'])
+
+    if args['engine'] == "threads":
+        threads = []
+        for k in smhi.keys:
+            threads.append(SmhiReader(smhi, k, day_store.put))  # Will start a thread for this key (resource)
+
+        for t in threads:
+            t.join()  # Wait for all reading threads to terminate
+
+        results = [t.get_data() for t in threads]
+    else:
+        results = smhi.get_all(smhi.keys, concurrency=args['concurrency'], per_host=args['per_host'],
+                               on_result=day_store.put)
+
+    for result in results:
+        if 'error' in result:
+            day_store.fail(result['resource'], result['error'])
+    nr_res = len([result for result in results if 'error' not in result])
+    nr_partial = len([result for result in results if result.get('failed')])
+    logger.info("Collected {} of {} resources ({} partial) in {:.1f}s (engine: {}, mode: {})".format(
+        nr_res, len(smhi.keys), nr_partial, time.time() - start_time, args['engine'],
+        "bulk" if smhi.bulk else "station"))
+    logger.info("HTTP: {}".format(get_client().summary()))
+    smhi.metrics.set("metobs_resources", nr_res - nr_partial, status="complete")
+    smhi.metrics.set("metobs_resources", nr_partial, status="partial")
+    smhi.metrics.set("metobs_resources", len(smhi.keys) - nr_res, status="failed")
+    smhi.metrics.set("metobs_run_seconds", time.time() - start_time)
+    smhi.metrics.set("metobs_run_timestamp_seconds", time.time())
+    logger.info("Metrics: {}".format(smhi.metrics.write(args['metrics_dir'], args['run_id'])))
+
+    if smhi.cache:
+        smhi.cache.save()
+
+    day_store.finish()
+    if smhi.journal:
+        # Keep the journal if something failed, the run can be resumed with the same run id
+        smhi.journal.close(remove=(nr_res == len(smhi.keys) and nr_partial == 0))
     logger.info("Done")
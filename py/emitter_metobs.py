@@ -6,16 +6,299 @@ __author__ = 'mm'
 # Mats Melander 2020-06-30
 # Script for emitting requests to retrieve meteorological observations as GeoJSON files
 #
+# Development server (single process, add -d for the debugger):
+# $ python emitter_metobs.py
+# Production, 4 worker processes with 8 threads each (needs gunicorn), workers are reloaded gracefully when the
+# collector points 'latest' at a new day:
+# $ python emitter_metobs.py -w 4 -t 8
+# or with any WSGI server, e.g. $ METOBS_ROOT=/data/metobs_data/ gunicorn -w 4 emitter_metobs:app
+#
 
 import os
-from flask import Flask, abort
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import importlib.util
+import zlib
+import bisect
+import fnmatch
+import mimetypes
+import threading
+import math
+import numpy as np
+from collections import OrderedDict
+from flask import Flask, Response, abort, jsonify, request, send_file
 from markupsafe import escape
-import glob
+import metobs_columnar
+import metobs_compress
+from metobs_query import ResourceIndex, join, EARTH_RADIUS
+import metobs_tiles
 
 app = Flask(__name__)
+# Let the front-end server (e.g. Apache mod_xsendfile or nginx) send the files, set METOBS_X_SENDFILE=1 if supported
+app.config['USE_X_SENDFILE'] = os.environ.get("METOBS_X_SENDFILE") == "1"
 
-ROOT = "metobs_data/"
+ROOT = os.environ.get("METOBS_ROOT", "metobs_data/")  # Relative to this script, or absolute
 LATEST = "latest"
+ENCODINGS = ('zstd', 'gzip')  # Precompressed variants served with Content-Encoding, in order of preference
+CACHE_BYTES = 64 * 1024 * 1024     # Max bytes of file bodies kept in memory, 0 to disable the cache
+CACHE_MAX_ENTRY = 8 * 1024 * 1024  # Files larger than this are always streamed from disk
+MAX_DIRS = 1000                    # Max number of directories in the index, it is cleared when full
+MAX_PATTERNS = 256                 # Max number of resolved patterns per directory, cleared when full
+MAX_RESOURCES = 64                 # Max number of resources loaded for queries, least recently used are dropped
+MAX_JOINS = 32                     # Max number of joined responses kept, least recently used are dropped
+MAX_TILES = 4096                   # Max number of vector tiles kept, least recently used are dropped
+MAX_ZOOM = 18                      # Max zoom level of vector tiles
+RELOAD_INTERVAL = 2.0              # Seconds between checks of 'latest' for a graceful reload of the workers
+
+logger = logging.getLogger('emitter')
+
+
+class BodyCache:
+    # LRU cache of file bodies in memory, bounded by the total number of bytes. Both compressed bodies (as stored) and
+    # decompressed bodies are kept, keyed by (resolved path, mtime, size, decompressed), so a rewritten file is never
+    # served from the cache. All bodies are dropped when the symbolic link 'latest' is pointed at a new day.
+    def __init__(self, max_bytes=CACHE_BYTES, max_entry=CACHE_MAX_ENTRY):
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.entries = OrderedDict()  # key: bytes, least recently used first
+        self.size = 0
+        self.latest = None  # Target of the symbolic link 'latest'
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check_latest(self, latest_path):
+        try:
+            target = os.readlink(latest_path)
+        except OSError:
+            target = None
+        with self.lock:
+            if target != self.latest:
+                self.entries.clear()
+                self.size = 0
+                self.latest = target
+
+    def get(self, key, load):
+        # Body of key, load() reads it from disk on a miss
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = load()
+        if len(data) <= self.max_entry:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = data
+                    self.size += len(data)
+                    while self.size > self.max_bytes:
+                        _, old = self.entries.popitem(last=False)
+                        self.size -= len(old)
+        return data
+
+
+cache = BodyCache()
+
+
+class DirIndex:
+    # Sorted file names per directory, so the file name pattern of a request, e.g. "01*", is resolved without a
+    # directory scan. A directory is listed again only when its mtime changes, i.e. when the collector adds, replaces
+    # or removes a file. Resolved patterns are kept per directory, a repeated pattern is a dictionary lookup. The
+    # patterns come from requests, so at most MAX_PATTERNS are kept per directory.
+    # Patterns are matched like glob.glob (sorted, first match), hidden files are not included
+    def __init__(self):
+        self.dirs = {}  # resolved path: {'mtime': ..., 'names': [sorted names], 'resolved': {pattern: name or None}}
+        self.lock = threading.Lock()
+
+    def _listing(self, path):
+        real = os.path.realpath(path)
+        try:
+            mtime = os.stat(real).st_mtime_ns
+        except OSError:
+            return None, None
+        with self.lock:
+            d = self.dirs.get(real)
+        if d is None or d['mtime'] != mtime:
+            try:
+                names = sorted(name for name in os.listdir(real) if not name.startswith("."))
+            except OSError:
+                return None, None
+            d = {'mtime': mtime, 'names': names, 'set': set(names), 'resolved': {}}
+            with self.lock:
+                if len(self.dirs) >= MAX_DIRS:
+                    self.dirs.clear()
+                self.dirs[real] = d
+        return real, d
+
+    @staticmethod
+    def _match(d, pattern):
+        if not any(c in pattern for c in "*?["):
+            return pattern if pattern in d['set'] else None
+        prefix = pattern[:-1]
+        if pattern.endswith("*") and not any(c in prefix for c in "*?["):
+            # "01*", the first name with the prefix
+            i = bisect.bisect_left(d['names'], prefix)
+            return d['names'][i] if i < len(d['names']) and d['names'][i].startswith(prefix) else None
+        return next((name for name in d['names'] if fnmatch.fnmatchcase(name, pattern)), None)
+
+    def names(self, path):
+        # Sorted names of the files in the directory path
+        _, d = self._listing(path)
+        return [] if d is None else d['names']
+
+    def resolve(self, path, pattern):
+        # Full name of the first file matching pattern in the directory path, None if there is no match. A plain file
+        # name of which only compressed variants are stored resolves to the first variant
+        real, d = self._listing(path)
+        if d is None:
+            return None
+        try:
+            name = d['resolved'][pattern]
+        except KeyError:
+            name = self._match(d, pattern)
+            if name is None:
+                name = next((n for n in (self._match(d, pattern + ext) for ext in metobs_compress.EXTS.values())
+                             if n is not None), None)
+            with self.lock:
+                if len(d['resolved']) >= MAX_PATTERNS:
+                    d['resolved'].clear()
+                d['resolved'][pattern] = name
+        return None if name is None else os.path.join(path, name)
+
+
+index = DirIndex()
+resources = OrderedDict()  # (resolved path, mtime, size): ResourceIndex, least recently used first
+joins = OrderedDict()  # (versions of the joined resources, how): joined response, least recently used first
+tiles = OrderedDict()  # (version of the resource, z, x, y): encoded vector tile, least recently used first
+resources_lock = threading.Lock()
+
+
+def day_dir(day):
+    # Directory of day, "latest" or "2020/07/03", None if day is not valid
+    if day.lower() == LATEST:
+        dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ROOT, LATEST)
+        cache.check_latest(dir_path)
+        return dir_path
+    parts = day.split("/")
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), ROOT, *parts)
+
+
+def day_keys(dir_path):
+    # Parameter keys of the resources stored in dir_path
+    names = (metobs_compress.split(name)[0] for name in index.names(dir_path))
+    return sorted({name.split("_")[0] for name in names if name.endswith(".geojson")})
+
+
+def resource_version(dir_path, key):
+    # File of the resource key in dir_path and its version, (resolved path, mtime, size). None if there is no such
+    # resource
+    fn = index.resolve(dir_path, key + "_*.geojson")
+    if fn is None:
+        return None, None
+    st = os.stat(fn)
+    return fn, (os.path.realpath(fn), st.st_mtime_ns, st.st_size)
+
+
+def resource_index(dir_path, key):
+    # ResourceIndex (metobs_query) of the resource key in dir_path, None if there is no such resource. The resource
+    # is loaded once per version of its file
+    fn, k = resource_version(dir_path, key)
+    if fn is None:
+        return None
+    name, _ = metobs_compress.split(fn)
+    with resources_lock:
+        if k in resources:
+            resources.move_to_end(k)
+            return resources[k]
+    fc = json.loads(metobs_compress.read(name))
+    res = ResourceIndex(fc['features'] if fc else [])
+    with resources_lock:
+        resources[k] = res
+        while len(resources) > MAX_RESOURCES:
+            resources.popitem(last=False)
+    return res
+
+
+def float_args(name, n, limits=None):
+    # n comma separated numbers of the request argument name, None if not given. limits is a list of (min, max), one
+    # per number, a number outside its limits is a bad request
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        res = [float(v) for v in value.split(",")]
+    except ValueError:
+        abort(400)
+    if len(res) != n or not all(math.isfinite(v) for v in res):
+        abort(400)
+    if limits is not None and not all(lo <= v <= hi for v, (lo, hi) in zip(res, limits)):
+        abort(400)
+    return res
+
+
+def send_json(obj):
+    # JSON response with an ETag of the body, so a repeated request with If-None-Match is answered with 304
+    response = jsonify(obj)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def send_cached(fn, mimetype, encoding=None, decompress=False):
+    # Send the file fn, stored with Content-Encoding encoding (None for a plain file). With decompress the body is
+    # decompressed and sent without Content-Encoding. Bodies are served from the cache, large files (and all files if
+    # X-Sendfile is enabled) are streamed by send_file (wsgi.file_wrapper or X-Sendfile)
+    # ETag and Last-Modified are set from the file. Conditional requests are answered with 304 and Range requests
+    # with 206
+    st = os.stat(fn)
+    if not decompress and (st.st_size > cache.max_entry or app.config['USE_X_SENDFILE']):
+        response = send_file(fn, mimetype=mimetype, conditional=True, etag=True)
+    else:
+        real = os.path.realpath(fn)
+
+        def load():
+            with open(real, mode='rb') as f:
+                data = f.read()
+            return metobs_compress.decompress(data, encoding) if decompress else data
+
+        data = cache.get((real, st.st_mtime_ns, st.st_size, decompress), load)
+        response = Response(data, mimetype=mimetype)
+        response.set_etag("{:x}-{:x}-{:x}{}".format(st.st_mtime_ns, st.st_size, zlib.adler32(real.encode()),
+                                                    "-identity" if decompress else ""))
+        response.last_modified = st.st_mtime
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+    if encoding is not None and not decompress:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def send_resource(fn):
+    # Send fn, a plain file or a precompressed variant (see metobs_compress). A variant accepted by the client is sent
+    # as is with Content-Encoding, for other clients a variant is decompressed if there is no plain file
+    name, _ = metobs_compress.split(fn)
+    files = metobs_compress.variants(name)
+    mimetype = mimetypes.guess_type(name)[0] or "text/plain"
+    encoding = next((e for e in ENCODINGS if e in files and request.accept_encodings[e]), None)
+    if encoding is None and None not in files:
+        encoding = next((e for e in ENCODINGS if e in files and metobs_compress.available(e)), None)
+        if encoding is None:
+            abort(404)
+        response = send_cached(files[encoding], mimetype, encoding, decompress=True)
+    else:
+        response = send_cached(files[encoding], mimetype, encoding)
+
+    if len(files) > 1 or None not in files:
+        response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.route('/metobs/<path:subpath>')
@@ -28,41 +311,242 @@ def get_file(subpath):
 
     if len(parts) == 2 and parts[0].lower() == LATEST:  # Option 1
         path = os.path.join(ROOT, LATEST)
-        #file_path = os.path.join(path, parts[1])
-        file_path =  os.path.join(os.path.dirname(os.path.abspath(__file__)), path, parts[1])
+        dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        cache.check_latest(dir_path)
+        pattern = parts[1]
     elif len(parts) == 4:  # Option 2
         path = os.path.join(ROOT, parts[0], parts[1], parts[2])
-        file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path, parts[3])
+        dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        pattern = parts[3]
     else:  # Not valid
-        path = file_path = ""
+        dir_path = pattern = ""
 
-    file_list = sorted(glob.glob(file_path)) if file_path else []
-    if file_list:
-        fn = file_list[0]
-        #fn = os.path.join(file_path, os.path.basename(str(file_list[0])))
+    fn = index.resolve(dir_path, pattern) if pattern else None
+    if fn:
         if os.path.isdir(fn):
             abort(404)
+        elif fn.endswith(metobs_columnar.EXT):
+            # Columnar companion file, binary
+            return send_cached(fn, "application/octet-stream")
         else:
-            with open(fn) as f:
-                res = f.read()
-            return res
+            return send_resource(fn)
     else:
         abort(404)
 
 
+@app.route('/metobs/query')
+def query():
+    # Features of one day filtered by parameter key, bounding box, distance from a point and station id, answered from
+    # an index of the resources in memory (see metobs_query). Arguments, all optional:
+    #   day=latest (default) or day=2020/07/03
+    #   key=01,04                                   parameter keys, default all resources of the day
+    #   bbox=min lon,min lat,max lon,max lat
+    #   point=lon,lat&radius=50                     within radius km from the point
+    #   station=Lund,Kiruna Flygplats               station ids
+    #   format=geojson (default), one FeatureCollection, or format=compact, column oriented per key:
+    #       {"01": {"station": [...], "lon": [...], "lat": [...], "height": [...], "updated": [...], "value": [...]}}
+    dir_path = day_dir(request.args.get("day", LATEST))
+    fmt = request.args.get("format", "geojson")
+    if dir_path is None or fmt not in ("geojson", "compact"):
+        abort(400)
+    keys = request.args["key"].split(",") if request.args.get("key") else day_keys(dir_path)
+    bbox = float_args("bbox", 4, [(-180.0, 180.0), (-90.0, 90.0)] * 2)
+    point = float_args("point", 2, [(-180.0, 180.0), (-90.0, 90.0)])
+    radius = float_args("radius", 1, [(0.0, math.pi * EARTH_RADIUS)])  # Max half the circumference
+    if (point is None) != (radius is None) or (bbox is not None and (bbox[0] > bbox[2] or bbox[1] > bbox[3])):
+        abort(400)
+    stations = request.args["station"].split(",") if request.args.get("station") else None
+
+    features = []
+    compact = {}
+    for key in keys:
+        res = resource_index(dir_path, key)
+        if res is None:
+            continue
+        rows = res.all()
+        if point is not None:
+            rows = res.radius(point[0], point[1], radius[0])
+        if bbox is not None:
+            rows = np.intersect1d(rows, res.bbox(*bbox))
+        if stations is not None:
+            rows = res.stations(stations, rows)
+        if fmt == "compact":
+            compact[key] = res.compact(rows)
+        else:
+            features.extend(res.feature_collection(rows)['features'])
+    return send_json(compact if fmt == "compact" else {"type": "FeatureCollection", "features": features})
+
+
+@app.route('/metobs/batch')
+def batch():
+    # Several resources of one day in one response, joined on station id: one row per station and one column of
+    # values per resource. Joined responses are kept per version of the resource files. Arguments:
+    #   key=03,04                 parameter keys, required
+    #   day=latest (default) or day=2020/07/03
+    #   join=inner (default), stations with values of all resources, or join=outer, stations of any resource
+    # Response: {"keys": ["03", "04"], "station": [...], "lon": [...], "lat": [...],
+    #            "values": {"03": [...], "04": [...]}}, null for a missing value
+    dir_path = day_dir(request.args.get("day", LATEST))
+    how = request.args.get("join", "inner")
+    if dir_path is None or how not in ("inner", "outer") or not request.args.get("key"):
+        abort(400)
+    keys = list(dict.fromkeys(request.args["key"].split(",")))
+    versions = [resource_version(dir_path, key)[1] for key in keys]
+    if None in versions:
+        abort(404)
+
+    k = (tuple(versions), how)
+    with resources_lock:
+        joined = joins.get(k)
+        if joined is not None:
+            joins.move_to_end(k)
+    if joined is None:
+        indexes = {key: resource_index(dir_path, key) for key in keys}
+        if None in indexes.values():
+            abort(404)  # Removed after resource_version
+        joined = join(indexes, how)
+        with resources_lock:
+            joins[k] = joined
+            while len(joins) > MAX_JOINS:
+                joins.popitem(last=False)
+    return send_json(joined)
+
+
+@app.route('/metobs/delta')
+def delta():
+    # Features of a resource updated after a watermark, for pollers. Arguments:
+    #   key=01                    parameter key, required
+    #   since=1593698400000       watermark, ms since epoch ('updated' of the features), default all features
+    #   day=latest (default) or day=2020/07/03
+    #   format=geojson (default) or format=compact, see query
+    # The response has the new watermark, the latest 'updated' of the resource, as "watermark". It is the since of the
+    # next request
+    dir_path = day_dir(request.args.get("day", LATEST))
+    fmt = request.args.get("format", "geojson")
+    key = request.args.get("key")
+    try:
+        since = int(request.args.get("since", -1))
+    except ValueError:
+        abort(400)
+    if dir_path is None or fmt not in ("geojson", "compact") or not key:
+        abort(400)
+    res = resource_index(dir_path, key)
+    if res is None:
+        abort(404)
+
+    rows = res.since(since)
+    result = res.compact(rows) if fmt == "compact" else res.feature_collection(rows)
+    watermark = res.watermark()
+    result['watermark'] = since if watermark is None else max(since, watermark)
+    return send_json(result)
+
+
+@app.route('/metobs/tiles/<key>/<int:z>/<int:x>/<int:y>.mvt')
+def vector_tile(key, z, x, y):
+    # Mapbox Vector Tile of the stations of resource key, see metobs_tiles. Stations are clustered at low zoom levels.
+    # Tiles are generated on demand and kept per version of the resource file. Argument:
+    #   day=latest (default) or day=2020/07/03
+    dir_path = day_dir(request.args.get("day", LATEST))
+    if dir_path is None or z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(400)
+    _, version = resource_version(dir_path, key)
+    if version is None:
+        abort(404)
+
+    k = (version, z, x, y)
+    with resources_lock:
+        data = tiles.get(k)
+        if data is not None:
+            tiles.move_to_end(k)
+    if data is None:
+        res = resource_index(dir_path, key)
+        if res is None:
+            abort(404)
+        data = metobs_tiles.tile(res, key, z, x, y)
+        with resources_lock:
+            tiles[k] = data
+            while len(tiles) > MAX_TILES:
+                tiles.popitem(last=False)
+
+    response = Response(data, mimetype="application/vnd.mapbox-vector-tile")
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 @app.route('/metobs/latest_file/<filename>')
 def latest_file(filename):
-    file_path = os.path.join(ROOT, LATEST, escape(filename))
-    file_list = sorted(glob.glob(file_path))
-    if file_list:
-        return os.path.basename(str(file_list[0]))
+    fn = index.resolve(day_dir(LATEST), str(escape(filename)))
+    if fn:
+        return metobs_compress.split(os.path.basename(fn))[0]
     else:
         abort(404)
 
+def watch_latest(server):
+    # gunicorn hook, run in the master process when it is ready. Reloads the workers gracefully (SIGHUP) when 'latest'
+    # is pointed at a new day, so the new workers start without the data of the old day in memory
+    latest_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ROOT, LATEST)
+
+    def target():
+        try:
+            return os.readlink(latest_path)
+        except OSError:
+            return None
+
+    def watch():
+        current = target()
+        while True:
+            time.sleep(RELOAD_INTERVAL)
+            if target() != current:
+                current = target()
+                server.log.info("latest -> {}, reloading workers".format(current))
+                os.kill(server.pid, signal.SIGHUP)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def serve(host, port, workers, threads, reload_on_flip=True):
+    # Production mode, gunicorn with workers processes of threads threads each
+    from gunicorn.app.base import BaseApplication
+
+    class EmitterApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', "{}:{}".format(host, port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', "gthread")
+            if reload_on_flip:
+                self.cfg.set('when_ready', watch_latest)
+
+        def load(self):
+            return app
+
+    EmitterApplication().run()
+
+
 if __name__ == "__main__":
-    # run with debugging enabled
-    app.run(
-        host="0.0.0.0",  # accessible from outside (optional, change to "127.0.0.1" if only local)
-        port=5000,
-        debug=True
-    )
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", required=False, default="0.0.0.0",
+                    help="address to listen on, 127.0.0.1 if only local")
+    ap.add_argument("-p", "--port", required=False, type=int, default=5000, help="port to listen on")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=0,
+                    help="number of worker processes (gunicorn), 0 for the development server")
+    ap.add_argument("-t", "--threads", required=False, type=int, default=4, help="threads per worker process")
+    ap.add_argument("-r", "--root", required=False, default=ROOT, help="directory of the collected data")
+    ap.add_argument("-n", "--no-reload", required=False, action="store_true",
+                    help="do not reload the workers when 'latest' is pointed at a new day")
+    ap.add_argument("-d", "--debug", required=False, action="store_true",
+                    help="development server with the debugger, never in production")
+    args = vars(ap.parse_args())
+    ROOT = args['root']
+
+    if args['workers'] > 0:
+        if args['debug']:
+            ap.error("the debugger (-d) is only available with the development server (-w 0)")
+        if importlib.util.find_spec("gunicorn") is None:
+            logger.error("Production mode (-w) needs gunicorn, install it with pip install -r requirements.txt")
+            sys.exit(1)
+        serve(args['host'], args['port'], args['workers'], args['threads'], not args['no_reload'])
+    else:
+        app.run(host=args['host'], port=args['port'], debug=args['debug'], threaded=True)
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Long-term archive of observations per station, one archive per resource (parameter key).
+# Filled by collector_metobs.py, queried by station set and time range.
+#
+# Layout, ARCHIVE_DIR/01/stations.json, ARCHIVE_DIR/01/2020-06.bin and ARCHIVE_DIR/01/2020-06.idx, ...
+# stations.json holds the station-id dictionary (station name -> code) and the date of the last record per station.
+# Each .bin-file is a chunk with the records of one month, fixed size records of RECORD. Records are appended to the
+# chunk, and when the appended tail has grown the chunk is compacted: sorted by station and date, without duplicates,
+# with the offset of each station's records in the .idx-file. A query for some stations reads only their records of the
+# sorted part, and the tail.
+# Records are only appended when newer than the last record of the station, so collecting the same data twice is safe.
+# New station codes are saved before records are written and the last dates after, so an interrupted append leaves at
+# most duplicate records (removed by query) and never records of a station without a name.
+#
+# The source of a record is LIVE, the observation date collected by collector_metobs.py, or BACKFILL, imported from the
+# daily directories which only hold the station's 'updated' time. The last dates are kept per source, so a backfill
+# never suppresses live observations.
+#
+# Backfill from the daily directories of the collector:
+# $ python metobs_archive.py -b metobs_data
+#
+# Query, e.g. temperature at two stations during 2020:
+#   archive = Archive()
+#   res = archive.query("01", stations=["Lund", "Kiruna Flygplats"], start=datetime.datetime(2020, 1, 1),
+#                       end=datetime.datetime(2021, 1, 1))
+#   res['station'], res['date'], res['value'], res['source'] are NumPy arrays sorted by date
+#
+
+import os
+import sys
+import json
+import glob
+import argparse
+import datetime
+import threading
+import numpy as np
+import metobs_compress
+from metobs_files import atomic_open
+
+ARCHIVE_DIR = "metobs_archive"
+STATIONS = "stations.json"
+CHUNK_EXT = ".bin"
+INDEX_EXT = ".idx"
+VERSION = 2            # Of the archive format, in stations.json
+LIVE, BACKFILL = 0, 1  # Source of a record
+COMPACT_MIN = 4096     # Records, a chunk is compacted when its tail is larger than this and a quarter of its sorted part
+RECORD = np.dtype([('station', '<i4'), ('source', '<i4'), ('date', '<i8'), ('value', '<f8')])  # date is ms since epoch
+
+
+def to_ms(t):
+    # Milliseconds since epoch for a datetime (naive is UTC) or a number
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=datetime.timezone.utc)
+        return int(t.timestamp() * 1000)
+    return int(t)
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan  # E.g. "regn"
+
+
+def chunk_name(ms):
+    return datetime.datetime.fromtimestamp(ms // 1000, tz=datetime.timezone.utc).strftime("%Y-%m") + CHUNK_EXT
+
+
+def chunk_range(name):
+    # [start, end) in milliseconds for a chunk file name
+    start = datetime.datetime.strptime(name[:-len(CHUNK_EXT)], "%Y-%m").replace(tzinfo=datetime.timezone.utc)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return to_ms(start), to_ms(end)
+
+
+class Archive:
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        # key: {'stations': [names], 'codes': {name: code}, 'last': {name: date}, 'backfilled': {name: date}}
+        self.params = {}
+
+    def _param(self, key):
+        if key not in self.params:
+            try:
+                with open(os.path.join(self.root, key, STATIONS), encoding='utf-8') as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                state = {'version': VERSION, 'stations': [], 'last': {}, 'backfilled': {}}
+            if state.get('version', 1) != VERSION:
+                raise ValueError("Archive {} is of format version {}, not {}, backfill a new archive".format(
+                    os.path.join(self.root, key), state.get('version', 1), VERSION))
+            state['codes'] = {name: code for code, name in enumerate(state['stations'])}
+            state['saved'] = len(state['stations'])  # Number of stations in stations.json
+            self.params[key] = state
+        return self.params[key]
+
+    def _save_param(self, key):
+        state = self.params[key]
+        fn = os.path.join(self.root, key, STATIONS)
+        with atomic_open(fn) as outfile:
+            json.dump(fp=outfile, obj={'version': VERSION, 'stations': state['stations'], 'last': state['last'],
+                                       'backfilled': state['backfilled']}, ensure_ascii=False)
+        state['saved'] = len(state['stations'])
+
+    def _chunk(self, key, name):
+        # File names of chunk name, e.g. "2020-06.bin", and of its index
+        fn = os.path.join(self.root, key, name)
+        return fn, fn[:-len(CHUNK_EXT)] + INDEX_EXT
+
+    @staticmethod
+    def _offsets(idx):
+        # Offsets of the index file idx, records of code c in the sorted part are [offsets[c], offsets[c + 1]) and the
+        # tail starts at offsets[-1]. None if the chunk is not compacted
+        try:
+            return np.load(idx)
+        except (OSError, ValueError):
+            return None
+
+    def _compact(self, key, name):
+        # Sort chunk name by station and date, without duplicates, and write its index. The index is removed first,
+        # so an interrupted compaction leaves a chunk without index, which is read in full
+        state = self.params[key]
+        fn, idx = self._chunk(key, name)
+        records = np.unique(np.fromfile(fn, dtype=RECORD))  # Sorted by station, source and date
+        records = records[records['station'] < len(state['stations'])]
+        if os.path.exists(idx):
+            os.remove(idx)
+        with atomic_open(fn, mode='wb') as outfile:
+            outfile.write(records.tobytes())
+        with atomic_open(idx, mode='wb') as outfile:
+            np.save(outfile, np.searchsorted(records['station'], np.arange(len(state['stations']) + 1)))
+
+    def append(self, key, rows, source=LIVE):
+        # Append rows, an iterable of (station name, date in ms, value), for resource key. Rows not newer than the last
+        # record of the station from the same source are skipped. Returns the number of appended records
+        with self.lock:
+            state = self._param(key)
+            known = state['last'] if source == LIVE else state['backfilled']
+            chunks = {}
+            last = {}  # New last date per station, saved when the records are written
+            for name, date, value in sorted(rows, key=lambda r: r[1]):
+                if date <= last.get(name, known.get(name, -1)):
+                    continue
+                if name not in state['codes']:
+                    state['codes'][name] = len(state['stations'])
+                    state['stations'].append(name)
+                last[name] = date
+                chunks.setdefault(chunk_name(date), []).append((state['codes'][name], source, date, to_float(value)))
+
+            if not chunks:
+                return 0
+
+            os.makedirs(os.path.join(self.root, key), exist_ok=True)
+            if state['saved'] < len(state['stations']):
+                self._save_param(key)  # Codes of new stations before any record refers to them
+            for name, records in chunks.items():
+                with open(self._chunk(key, name)[0], mode='ab') as outfile:
+                    outfile.write(np.array(records, dtype=RECORD).tobytes())
+            known.update(last)
+            self._save_param(key)
+
+            for name in chunks:
+                fn, idx = self._chunk(key, name)
+                offsets = self._offsets(idx)
+                n = int(offsets[-1]) if offsets is not None else 0
+                if os.path.getsize(fn) // RECORD.itemsize - n > max(COMPACT_MIN, n // 4):
+                    self._compact(key, name)
+            return sum(len(records) for records in chunks.values())
+
+    def stations(self, key):
+        with self.lock:
+            return list(self._param(key)['stations'])
+
+    def query(self, key, stations=None, start=None, end=None):
+        # Records of resource key for stations (list of names, None for all) with start <= date < end (datetime or
+        # ms, None for no limit). Returns {'station': names, 'date': ms, 'value': values, 'source': LIVE or BACKFILL} as
+        # NumPy arrays sorted by date
+        start = -2 ** 63 if start is None else to_ms(start)
+        end = 2 ** 63 - 1 if end is None else to_ms(end)
+        with self.lock:
+            state = self._param(key)
+            names = np.array(state['stations'], dtype=str)
+            codes = None if stations is None else \
+                np.array([state['codes'][s] for s in stations if s in state['codes']], dtype=np.int32)
+            # Chunks and their indexes are opened while holding the lock, so a compaction is not seen half done
+            chunks = []
+            for fn in sorted(glob.glob(os.path.join(self.root, key, "*" + CHUNK_EXT))):
+                chunk_start, chunk_end = chunk_range(os.path.basename(fn))
+                if chunk_end <= start or chunk_start >= end or os.path.getsize(fn) == 0:
+                    continue  # The chunk is outside the time range, no need to read it
+                offsets = self._offsets(self._chunk(key, os.path.basename(fn))[1])
+                chunks.append((np.memmap(fn, dtype=RECORD, mode='r'), offsets))
+
+        parts = []
+        for records, offsets in chunks:
+            if codes is not None and offsets is not None:
+                # Only the records of the stations in the sorted part, then the tail
+                records = np.concatenate([records[offsets[c]:offsets[c + 1]] for c in codes if c < len(offsets) - 1] +
+                                         [records[int(offsets[-1]):]])
+            # Codes without a name are skipped, they can only come from an interrupted append of an earlier version
+            mask = (records['date'] >= start) & (records['date'] < end) & (records['station'] < len(names))
+            if codes is not None:
+                mask &= np.isin(records['station'], codes)
+            parts.append(np.array(records[mask]))
+
+        records = np.concatenate(parts) if parts else np.empty(0, dtype=RECORD)
+        records = np.unique(records)  # Sorted, and without duplicates from an interrupted append
+        records = records[np.argsort(records['date'], kind='stable')]
+        return {'station': names[records['station']] if len(names) else np.empty(0, dtype=str),
+                'date': records['date'],
+                'value': records['value'],
+                'source': records['source']}
+
+
+def backfill(archive, metobs_dir):
+    # Import the daily directories, metobs_dir/2020/06/21/*.geojson, in date order. The daily files only hold the
+    # station's 'updated' time, which is used as the date of the records, of source BACKFILL
+    days = sorted(glob.glob(os.path.join(metobs_dir, "[0-9][0-9][0-9][0-9]", "[0-9][0-9]", "[0-9][0-9]")))
+    for day in days:
+        nr = 0
+        # Plain or compressed, see metobs_compress
+        names = sorted({metobs_compress.split(fn)[0] for fn in glob.glob(os.path.join(day, "*.geojson*"))})
+        for fn in names:
+            key = os.path.basename(fn)[:2]
+            try:
+                fc = json.loads(metobs_compress.read(fn))
+            except (OSError, json.decoder.JSONDecodeError) as e:
+                print("Skipping {}: {}".format(fn, e))
+                continue
+            if not fc:
+                continue
+            nr += archive.append(key, [(feature['id'], feature['properties']['updated'],
+                                        feature['properties']['value']) for feature in fc['features']],
+                                  source=BACKFILL)
+        print("{}: {} records".format(day, nr))
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-b", "--backfill", required=False, help="import the daily directories from this directory")
+    ap.add_argument("-a", "--archive", required=False, default=ARCHIVE_DIR, help="archive directory")
+    args = vars(ap.parse_args())
+
+    if args['backfill']:
+        backfill(Archive(args['archive']), args['backfill'])
+    else:
+        print("Nothing to do, see -h")
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Load test of emitter_metobs.py against a synthetic archive, reports requests/s and p50/p99 latency per endpoint.
+# The archive is generated in a temporary directory (or --root) and the emitter is started on a local port.
+#
+# Development server:
+# $ python metobs_bench.py
+# Production mode, 4 workers with 8 threads each:
+# $ python metobs_bench.py -w 4 -t 8 -c 32 -s 10
+#
+# The load is generated by threads of this process, one keep-alive connection per thread. With many workers the
+# load generator itself may be the limit, compare with an external tool (e.g. wrk) when sizing for real.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import requests
+import numpy as np
+import metobs_columnar
+import metobs_compress
+
+KEYS = ["01", "03", "04", "06", "07", "09", "39"]
+
+
+def make_archive(root, days, keys, stations):
+    # ROOT/YYYY/MM/DD/<key>_T<key>__S.geojson (plain, gzip and columnar) and meta.json for days days back from today,
+    # and the symbolic link 'latest' to the last day. The first day is stored compressed only (gzip, no plain file),
+    # as by collector_metobs.py -o. Returns the paths of the last and the first day
+    rnd = random.Random(1)
+    today = datetime.datetime.now()
+    day_path = None
+    first_path = None
+    for d in range(days - 1, -1, -1):
+        day = today - datetime.timedelta(days=d)
+        day_path = os.path.join(day.strftime("%Y"), day.strftime("%m"), day.strftime("%d"))
+        first_path = first_path or day_path
+        path = os.path.join(root, day_path)
+        os.makedirs(path, exist_ok=True)
+        translations = {}
+        for key in keys:
+            updated = int(day.timestamp()) * 1000
+            features = [{"type": "Feature", "id": "Station {}".format(i),
+                         "geometry": {"type": "Point", "coordinates": [round(rnd.uniform(11.0, 24.0), 6),
+                                                                      round(rnd.uniform(55.0, 69.0), 6)]},
+                         "properties": {"key": key, "title": "T" + key, "summary": "S", "updated": updated + i,
+                                        "timestamp": day.strftime("%Y-%m-%d %H:%M:%S.000"),
+                                        "height": round(rnd.uniform(0, 1000), 1), "value": round(rnd.gauss(10, 5), 1)}}
+                        for i in range(stations)]
+            fc = {"type": "FeatureCollection", "features": features}
+            fn = os.path.join(path, "{}_T{}__S.geojson".format(key, key))
+            data = json.dumps(fc, ensure_ascii=False).encode('utf-8')
+            if day_path != first_path or days == 1:
+                with open(fn, mode='wb') as f:
+                    f.write(data)
+            with open(fn + metobs_compress.EXTS['gzip'], mode='wb') as f:
+                f.write(metobs_compress.compress(data, 'gzip'))
+            metobs_columnar.save(fn[:-len(".geojson")] + metobs_columnar.EXT, fc)
+            translations[key] = {'resource': {'key': key, 'title': "T" + key, 'summary': "S"}}
+        with open(os.path.join(path, "meta.json"), encoding='utf-8', mode='w') as f:
+            json.dump({"generated": day.strftime("%Y-%m-%d %H:%M:%S"), "resources": str(len(keys)),
+                       "translations": translations}, f)
+
+    latest = os.path.join(root, "latest")
+    if os.path.lexists(latest):
+        os.remove(latest)
+    os.symlink(day_path, latest)
+    return day_path.replace(os.sep, "/"), first_path.replace(os.sep, "/")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_emitter(root, port, workers, threads):
+    emitter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emitter_metobs.py")
+    proc = subprocess.Popen([sys.executable, emitter, "--host", "127.0.0.1", "-p", str(port), "-r", root,
+                             "-w", str(workers), "-t", str(threads)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get("http://127.0.0.1:{}/metobs/latest/meta.json".format(port), timeout=1)
+            return proc
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("The emitter did not start")
+
+
+def load(urls, concurrency, duration, headers=None):
+    # Requests to random urls of the list from concurrency threads during duration seconds. Returns
+    # {'requests': n, 'errors': n, 'rps': ..., 'p50': ms, 'p99': ms}
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def run():
+        session = requests.Session()
+        rnd = random.Random()
+        own = []
+        failed = 0
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                r = session.get(rnd.choice(urls), headers=headers, timeout=30)
+                ok = r.status_code == 200
+                r.content
+            except requests.exceptions.RequestException:
+                ok = False
+            own.append(time.perf_counter() - start)
+            failed += 0 if ok else 1
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    start = time.time()
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    ms = np.array(latencies) * 1000
+    return {'requests': len(latencies), 'errors': errors[0], 'rps': len(latencies) / elapsed,
+            'p50': float(np.percentile(ms, 50)) if len(ms) else 0.0,
+            'p99': float(np.percentile(ms, 99)) if len(ms) else 0.0}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-w", "--workers", required=False, type=int, default=0,
+                    help="emitter worker processes, 0 for the development server")
+    ap.add_argument("-t", "--threads", required=False, type=int, default=4, help="threads per emitter worker")
+    ap.add_argument("-c", "--concurrency", required=False, type=int, default=8, help="concurrent client connections")
+    ap.add_argument("-s", "--seconds", required=False, type=float, default=5.0, help="duration of each test")
+    ap.add_argument("-d", "--days", required=False, type=int, default=30, help="days in the synthetic archive")
+    ap.add_argument("-n", "--stations", required=False, type=int, default=400, help="stations per resource")
+    ap.add_argument("-r", "--root", required=False, help="directory of the synthetic archive, default a temporary")
+    ap.add_argument("-o", "--output", required=False, help="also write the results as JSON to this file")
+    args = vars(ap.parse_args())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.abspath(args['root'] or tmp)
+        day, first_day = make_archive(root, args['days'], KEYS, args['stations'])
+        port = free_port()
+        proc = start_emitter(root, port, args['workers'], args['threads'])
+        base = "http://127.0.0.1:{}/metobs/".format(port)
+        # requests sends "Accept-Encoding: gzip, deflate" by default, the plain rows ask for identity explicitly
+        identity = {'Accept-Encoding': "identity"}
+        tests = [("get_file latest", [base + "latest/" + key + "*" for key in KEYS], identity),
+                 ("get_file latest gzip", [base + "latest/" + key + "*" for key in KEYS], {'Accept-Encoding': "gzip"}),
+                 ("get_file day", [base + day + "/" + key + "*" for key in KEYS], identity),
+                 ("get_file gzip-only day", [base + first_day + "/" + key + "*" for key in KEYS], identity),
+                 ("get_file npz", [base + "latest/" + key + "*.npz" for key in KEYS], identity),
+                 ("latest_file", [base + "latest_file/" + key + "*" for key in KEYS], identity)]
+        results = {}
+        try:
+            print("{} days, {} resources of {} stations, {}, {} connections".format(
+                args['days'], len(KEYS), args['stations'],
+                "{} workers x {} threads".format(args['workers'], args['threads']) if args['workers'] else
+                "development server", args['concurrency']))
+            print("{:<22} {:>9} {:>7} {:>10} {:>9} {:>9}".format("endpoint", "requests", "errors", "req/s",
+                                                                 "p50 ms", "p99 ms"))
+            for name, urls, headers in tests:
+                res = load(urls, args['concurrency'], args['seconds'], headers)
+                results[name] = res
+                print("{:<22} {:>9} {:>7} {:>10.1f} {:>9.2f} {:>9.2f}".format(name, res['requests'], res['errors'],
+                                                                              res['rps'], res['p50'], res['p99']))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    if args['output']:
+        with open(args['output'], encoding='utf-8', mode='w') as f:
+            json.dump({'workers': args['workers'], 'threads': args['threads'], 'concurrency': args['concurrency'],
+                       'results': results}, f, indent=1)
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Columnar companion format for the collected resources, stored as a NumPy .npz-file next to each .geojson-file.
+# Loading the columns is much faster than parsing the GeoJSON and the files are smaller.
+#
+# Columns, one element per feature:
+#   lon, lat   float64
+#   height     float64, NaN if unknown
+#   updated    int64, milliseconds since epoch
+#   value      float64, NaN if the value is not a number
+#   text       str, the value if it is not a number (e.g. "regn"), otherwise ""
+#   station    int32, index into station_ids
+# and the station-id dictionary:
+#   station_ids  str, the feature id (station name) of each station
+#
+
+import numpy as np
+
+EXT = ".npz"
+
+
+def from_features(features):
+    # Columns from a list of GeoJSON Point features, as created by the collector
+    station_ids = []
+    station_index = {}
+    station = np.empty(len(features), dtype=np.int32)
+    lon = np.empty(len(features))
+    lat = np.empty(len(features))
+    height = np.empty(len(features))
+    updated = np.empty(len(features), dtype=np.int64)
+    value = np.empty(len(features))
+    text = []
+    for i, f in enumerate(features):
+        if f["id"] not in station_index:
+            station_index[f["id"]] = len(station_ids)
+            station_ids.append(f["id"])
+        station[i] = station_index[f["id"]]
+        lon[i], lat[i] = f["geometry"]["coordinates"][:2]
+        props = f["properties"]
+        height[i] = np.nan if props["height"] is None else props["height"]
+        updated[i] = props["updated"]
+        if isinstance(props["value"], str):
+            value[i] = np.nan
+            text.append(props["value"])
+        else:
+            value[i] = props["value"]
+            text.append("")
+
+    return {'lon': lon, 'lat': lat, 'height': height, 'updated': updated, 'value': value,
+            'text': np.array(text, dtype=str), 'station': station, 'station_ids': np.array(station_ids, dtype=str)}
+
+
+def save(f, fc):
+    # Write the FeatureCollection fc in columnar format to f, a file name or a file object opened in binary mode
+    np.savez_compressed(f, **from_features(fc["features"]))
+
+
+def load(f):
+    # Read columns from f, a file name or a file object (e.g. io.BytesIO of a downloaded file). Returns a dictionary of
+    # NumPy arrays, see above
+    with np.load(f, allow_pickle=False) as npz:
+        return {k: npz[k] for k in npz.files}
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Precompressed variants of the collected files, "01_X.geojson.gz" (gzip) and "01_X.geojson.zst" (zstd), written by
+# collector_metobs.py next to (or instead of) the plain file and served by emitter_metobs.py with Content-Encoding.
+# zstd needs the optional package zstandard, without it only gzip is available.
+#
+
+import os
+import gzip
+
+try:
+    import zstandard  # Optional, faster and smaller than gzip
+except ImportError:
+    zstandard = None
+
+EXTS = {'gzip': ".gz", 'zstd': ".zst"}  # Content-Encoding: file name suffix
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def available(encoding):
+    return encoding == 'gzip' or (encoding == 'zstd' and zstandard is not None)
+
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def decompress(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def split(fn):
+    # "01_X.geojson.gz" -> ("01_X.geojson", 'gzip'), "01_X.geojson" -> ("01_X.geojson", None)
+    for encoding, ext in EXTS.items():
+        if fn.endswith(ext):
+            return fn[:-len(ext)], encoding
+    return fn, None
+
+
+def variants(fn):
+    # Existing files of the plain file name fn, {None: fn, 'gzip': fn + ".gz", ...}
+    res = {None: fn} if os.path.isfile(fn) else {}
+    for encoding, ext in EXTS.items():
+        if os.path.isfile(fn + ext):
+            res[encoding] = fn + ext
+    return res
+
+
+def read(fn):
+    # Contents of the plain file name fn, from the plain file or a compressed variant
+    for encoding, name in variants(fn).items():
+        if encoding is None or available(encoding):
+            with open(name, mode='rb') as f:
+                data = f.read()
+            return data if encoding is None else decompress(data, encoding)
+    raise FileNotFoundError(fn)
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Atomic writes of files read by other processes (the emitter, node_exporter, a concurrent collector run).
+# A file is written to a hidden temporary file in the same directory, ".name.tmp", and renamed to its name when
+# complete, so a reader sees either the old or the new file. The temporary file is never matched by the wildcards of
+# emitter_metobs.py. On an error the temporary file is removed and the old file is kept.
+#
+# write_text("metobs_data/manifest.json", text)
+# with atomic_open("fixtures.zip", mode='wb') as f:
+#     ...
+#
+
+import os
+from contextlib import contextmanager
+
+
+def tmp_name(fn):
+    # Temporary file in the same directory as fn, hidden
+    return os.path.join(os.path.dirname(fn), "." + os.path.basename(fn) + ".tmp")
+
+
+@contextmanager
+def atomic_open(fn, mode='w'):
+    # open() of a temporary file which is renamed to fn when the block completes, text mode is UTF-8
+    tmp = tmp_name(fn)
+    try:
+        with open(tmp, mode=mode, encoding=None if 'b' in mode else 'utf-8') as outfile:
+            yield outfile
+        os.replace(tmp, fn)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_bytes(fn, data):
+    with atomic_open(fn, mode='wb') as outfile:
+        outfile.write(data)
+
+
+def write_text(fn, text):
+    with atomic_open(fn, mode='w') as outfile:
+        outfile.write(text)
+
+
+def replace_symlink(target, fn):
+    # Point the symbolic link fn at target, replaced atomically
+    tmp = tmp_name(fn)
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, fn)
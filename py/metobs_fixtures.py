@@ -0,0 +1,114 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Record/replay of HTTP responses, for reproducible benchmarks and load tests without SMHI or viltstigen.se
+#
+# Record: all requests through metobs_http (collector, swe_weather and swe_lightnings) are stored in a fixture
+# archive when the environment variable METOBS_RECORD is set, several scripts can record into the same archive
+# $ METOBS_RECORD=fixtures.zip python collector_metobs.py
+# $ METOBS_RECORD=fixtures.zip python swe_weather.py
+#
+# Replay: run the stand-in server, optionally with latency and failures injected, and point the scripts at it
+# $ python metobs_fixtures.py -a fixtures.zip -p 8080 --latency 0.05 --jitter 0.02 --fail-rate 0.01
+# $ METOBS_REPLAY=http://127.0.0.1:8080 python collector_metobs.py
+#
+# The archive is a zip-file with index.json, {"host/path?query": {"status": 200, "type": "...", "body": "b/1"}, ...},
+# and one compressed entry per response body. The scheme of urls is not part of the key.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import threading
+from flask import Flask, Response, abort, request
+from metobs_files import atomic_open
+
+INDEX = "index.json"
+
+app = Flask(__name__)
+
+
+def url_key(url):
+    # "https://host/path?query" -> "host/path?query"
+    return url.split("://", 1)[-1]
+
+
+class FixtureArchive:
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.entries = {}  # key: (status, content type, body)
+        if os.path.exists(fn):
+            with zipfile.ZipFile(fn) as z:
+                index = json.loads(z.read(INDEX))
+                for key, entry in index.items():
+                    self.entries[key] = (entry['status'], entry['type'], z.read(entry['body']))
+
+    def add(self, url, status, content_type, body):
+        with self.lock:
+            self.entries[url_key(url)] = (status, content_type, body)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def save(self):
+        with self.lock:
+            index = {}
+            with atomic_open(self.fn, mode='wb') as outfile, \
+                    zipfile.ZipFile(outfile, mode='w', compression=zipfile.ZIP_DEFLATED) as z:
+                for i, (key, (status, content_type, body)) in enumerate(sorted(self.entries.items())):
+                    index[key] = {'status': status, 'type': content_type, 'body': "b/{}".format(i)}
+                    z.writestr(index[key]['body'], body)
+                z.writestr(INDEX, json.dumps(index, ensure_ascii=False))
+
+
+settings = {'archive': None, 'latency': 0.0, 'jitter': 0.0, 'fail_rate': 0.0, 'fail_status': 503}
+
+
+@app.route('/<path:subpath>')
+def replay(subpath):
+    if settings['latency'] or settings['jitter']:
+        time.sleep(settings['latency'] + random.uniform(0, settings['jitter']))
+    if random.random() < settings['fail_rate']:
+        abort(settings['fail_status'])
+
+    key = subpath + ("?" + request.query_string.decode() if request.query_string else "")
+    entry = settings['archive'].get(key)
+    if entry is None:
+        abort(404)
+    status, content_type, body = entry
+    return Response(body, status=status, content_type=content_type)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-a", "--archive", required=True, help="fixture archive to replay")
+    ap.add_argument("-p", "--port", required=False, type=int, default=8080, help="port of the stand-in server")
+    ap.add_argument("--latency", required=False, type=float, default=0.0, help="seconds added to each response")
+    ap.add_argument("--jitter", required=False, type=float, default=0.0, help="max random seconds added to latency")
+    ap.add_argument("--fail-rate", required=False, type=float, default=0.0,
+                    help="fraction of requests answered with --fail-status")
+    ap.add_argument("--fail-status", required=False, type=int, default=503, help="HTTP status of injected failures")
+    ap.add_argument("-l", "--list", required=False, action="store_true", help="list the archive and exit")
+    args = vars(ap.parse_args())
+
+    if not os.path.exists(args['archive']):
+        print("No such archive: {}".format(args['archive']))
+        sys.exit(1)
+    settings['archive'] = FixtureArchive(args['archive'])
+
+    if args['list']:
+        for k, (status, content_type, body) in sorted(settings['archive'].entries.items()):
+            print("{} {} {} {}".format(status, len(body), content_type, k))
+    else:
+        settings['latency'] = args['latency']
+        settings['jitter'] = args['jitter']
+        settings['fail_rate'] = args['fail_rate']
+        settings['fail_status'] = args['fail_status']
+        app.run(host="127.0.0.1", port=args['port'], threaded=True)
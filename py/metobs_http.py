@@ -0,0 +1,206 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Shared HTTP client for the collector and the renderers.
+# One requests.Session with keep-alive connections pooled per host, retries with jittered exponential backoff on
+# transient errors and timing of each request.
+# The number of concurrent requests per host is controlled adaptively (AdaptiveLimit), it is increased while
+# responses are fast and successful and decreased on 429/5xx responses, connection errors or rising latency.
+# Responses can be recorded into a fixture archive and replayed by a stand-in server, see metobs_fixtures.
+#
+
+import os
+import atexit
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 16                              # Max number of kept-alive connections per host
+RETRIES = 4                                 # Number of retries after the first attempt
+BACKOFF = 0.5                               # Base delay in seconds before a retry, doubled for each retry
+BACKOFF_MAX = 30.0                          # Max delay in seconds before a retry
+TIMEOUT = 30                                # Seconds to wait for connect and for each read
+RETRY_STATUS = (429, 500, 502, 503, 504)    # HTTP status codes that are retried
+MAX_TIMINGS = 10000                         # Max number of request timings kept
+RECORD_ENV = "METOBS_RECORD"                # Fixture archive to record all responses into, see metobs_fixtures
+REPLAY_ENV = "METOBS_REPLAY"                # Base url of a stand-in server replaying a fixture archive
+
+# Settings of AdaptiveLimit per host, hosts not listed use DEFAULT_LIMIT
+# initial/minimum/maximum: number of concurrent requests, latency_target: seconds (moving average) before decreasing,
+# cooldown: min seconds between two decreases. A maximum above POOL_SIZE, or above the per-host cap of the caller
+# (collector_metobs.MAX_PER_HOST), is never reached
+DEFAULT_LIMIT = {'initial': 4, 'minimum': 1, 'maximum': 16, 'latency_target': 2.0, 'cooldown': 1.0}
+HOST_LIMITS = {
+    "opendata-download-metobs.smhi.se": {'initial': 8, 'minimum': 1, 'maximum': 16, 'latency_target': 2.0,
+                                         'cooldown': 1.0},
+    "opendata-download-lightning.smhi.se": {'initial': 2, 'minimum': 1, 'maximum': 4, 'latency_target': 5.0,
+                                            'cooldown': 2.0},
+}
+
+logger = logging.getLogger('http')
+
+
+class AdaptiveLimit:
+    # Limit of concurrent requests to one host, additive increase/multiplicative decrease (AIMD).
+    # Each healthy response increases the limit by 1/limit, i.e. by one when a full limit of requests has succeeded,
+    # but only while the limit is the bottleneck: requests in flight at most one below it. Under light load it stays.
+    # An error or a moving average of the latency above latency_target halves the limit, at most once per cooldown.
+    def __init__(self, initial=4, minimum=1, maximum=16, latency_target=2.0, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.inflight = 0
+        self.latency = None  # Exponential moving average, seconds
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def release(self, elapsed, ok):
+        # elapsed is the latency of the request, ok is False for errors indicating overload
+        with self.cond:
+            busy = self.inflight >= int(self.limit) - 1  # Counting this request
+            self.inflight -= 1
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            if not ok or self.latency > self.latency_target:
+                now = time.time()
+                if now - self.last_decrease > self.cooldown:
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self.last_decrease = now
+                    self.decreases += 1
+            elif busy:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+
+class HttpClient:
+    def __init__(self, pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT, host_limits=None,
+                 recorder=None, replay=None):
+        self.recorder = recorder  # metobs_fixtures.FixtureArchive, all responses are added to it
+        self.replay = replay      # Base url of a stand-in server, all requests are sent to it
+        self.host_limits = HOST_LIMITS if host_limits is None else host_limits
+        self.limits = {}  # host: AdaptiveLimit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        # pool_connections is the number of hosts to keep pools for, pool_maxsize the connections per host
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        # One entry per request: {'url': ..., 'status': ..., 'elapsed': ..., 'bytes': ..., 'attempts': ...}
+        self.timings = []
+
+    def delay(self, attempt, response=None):
+        # Seconds to wait before retry number attempt (0 is the first retry), honours Retry-After if given
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return min(float(response.headers["Retry-After"]), BACKOFF_MAX)
+        return random.uniform(0, min(self.backoff * 2 ** attempt, BACKOFF_MAX))  # Full jitter
+
+    def limit(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.limits:
+                self.limits[host] = AdaptiveLimit(**self.host_limits.get(host, DEFAULT_LIMIT))
+            return self.limits[host]
+
+    def replay_url(self, url):
+        # "https://host/path" -> "http://stand-in/host/path"
+        return self.replay.rstrip("/") + "/" + url.split("://", 1)[-1] if self.replay else url
+
+    def limited_get(self, url, **kwargs):
+        # One attempt, within the adaptive limit of the host (also when replayed)
+        limit = self.limit(url)
+        limit.acquire()
+        start = time.time()
+        ok = False
+        try:
+            r = self.session.get(self.replay_url(url), **kwargs)
+            ok = r.status_code not in RETRY_STATUS
+            return r
+        finally:
+            limit.release(time.time() - start, ok)
+
+    def get(self, url, **kwargs):
+        # GET with retries, the final response is returned also for an error status (use raise_for_status)
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        attempt = 0
+        while True:
+            try:
+                r = self.limited_get(url, **kwargs)
+                if r.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    break
+                wait = self.delay(attempt, r)
+                logger.info("{}: status {}, retry in {:.1f}s".format(url, r.status_code, wait))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries:
+                    self.record(url, None, time.time() - start, 0, attempt + 1)
+                    raise
+                wait = self.delay(attempt)
+                logger.info("{}: {}, retry in {:.1f}s".format(url, e, wait))
+            time.sleep(wait)
+            attempt += 1
+
+        self.record(url, r.status_code, time.time() - start, len(r.content), attempt + 1)
+        if self.recorder is not None:
+            self.recorder.add(url, r.status_code, r.headers.get("Content-Type", ""), r.content)
+        return r
+
+    def get_json(self, url, **kwargs):
+        r = self.get(url, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+    def record(self, url, status, elapsed, size, attempts):
+        with self.lock:
+            if len(self.timings) >= MAX_TIMINGS:
+                del self.timings[:MAX_TIMINGS // 2]
+            self.timings.append({'url': url, 'status': status, 'elapsed': elapsed, 'bytes': size,
+                                 'attempts': attempts})
+
+    def summary(self):
+        with self.lock:
+            n = len(self.timings)
+            elapsed = sum(t['elapsed'] for t in self.timings)
+            size = sum(t['bytes'] for t in self.timings)
+            retried = sum(1 for t in self.timings if t['attempts'] > 1)
+            limits = ", ".join("{}: limit {:.1f} ({} decreases)".format(host, limit.limit, limit.decreases)
+                               for host, limit in self.limits.items())
+        return "{} requests, {:.0f} kB, avg {:.0f} ms, {} retried; {}".format(n, size / 1024,
+                                                                              1000 * elapsed / n if n else 0, retried,
+                                                                              limits)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(pool_size=POOL_SIZE):
+    # The shared client, created at first call. pool_size should match the number of threads/workers doing requests,
+    # it is only used when the client is created.
+    # Recording and replay are set up from the environment variables RECORD_ENV and REPLAY_ENV
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(pool_size=pool_size, replay=os.environ.get(REPLAY_ENV))
+            if os.environ.get(RECORD_ENV):
+                from metobs_fixtures import FixtureArchive
+                _client.recorder = FixtureArchive(os.environ[RECORD_ENV])
+                atexit.register(_client.recorder.save)
+        return _client
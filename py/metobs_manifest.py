@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Manifest of collected days and their resources, ROOT/manifest.json, and rendering of the root index.html from it.
+# The root index.html is made of one section per year. Each section is rendered to ROOT/.index/2020.html when a day of
+# that year is added, so adding a day re-renders only the section of its year, independent of the age of the archive.
+#
+# manifest.json: {"days": {"2020/06/21": ["01", "02", ...], ...}}
+#
+# Must be used within a Flask application context (render_template)
+#
+
+import os
+import glob
+import json
+from flask import render_template
+import metobs_compress
+from metobs_files import write_text
+
+MANIFEST = "manifest.json"
+SECTIONS_DIR = ".index"
+INDEX_HTML = "index.html"
+
+
+def init_row():
+    row = {}
+    for i in range(1, 13):
+        row["{:02d}".format(i)] = {'path': '', 'str': ''}
+    return row
+
+
+def year_table(days):
+    # days is a list of "2020/06/23" strings from one year
+    # result = {'23': {'01': {'path': "", 'str': ""},
+    #                  '02': {'path': "", 'str': ""},
+    #                   ...
+    #                  '06': {'path': "2020/06/23", 'str': "23"},
+    #                  '07': {'path': "", 'str': ""},
+    #                   ...
+    #                  '12': {'path': "", 'str: ""}
+    #                  }
+    #          }
+    table = {}
+    for day_path in days:
+        _, month, day = day_path.split("/")
+        if day not in table:
+            table[day] = init_row()
+        table[day][month] = {'path': day_path, 'str': day}
+    return table
+
+
+class Manifest:
+    def __init__(self, root):
+        self.root = root
+        self.fn = os.path.join(root, MANIFEST)
+        try:
+            with open(self.fn, encoding='utf-8') as f:
+                self.days = json.load(f)['days']
+        except (OSError, KeyError, json.decoder.JSONDecodeError):
+            self.days = self.scan()
+            self.save()
+
+    def scan(self):
+        # Find all day directories with an index.html, ROOT/2020/06/23/index.html. Only needed once, to create the
+        # manifest for an existing archive
+        days = {}
+        for fn in glob.glob(os.path.join(self.root, "[0-9]*", "[0-9]*", "[0-9]*", INDEX_HTML)):
+            day_dir = os.path.dirname(fn)
+            day_path = os.path.relpath(day_dir, self.root).replace(os.sep, "/")
+            days[day_path] = sorted({name[:2] for name in os.listdir(day_dir)
+                                     if metobs_compress.split(name)[0].endswith(".geojson")})
+        return days
+
+    def save(self):
+        write_text(self.fn, json.dumps({'days': self.days}, ensure_ascii=False, sort_keys=True))
+
+    def years(self):
+        return sorted({day_path.split("/")[0] for day_path in self.days})
+
+    def add(self, day_path, keys):
+        # Add (or update) the day "2020/06/23" with the resource keys, and re-render the section of its year
+        self.days[day_path] = sorted(keys)
+        self.save()
+        self.render_year(day_path.split("/")[0])
+
+    def section_name(self, year):
+        return os.path.join(self.root, SECTIONS_DIR, year + ".html")
+
+    def render_year(self, year):
+        os.makedirs(os.path.join(self.root, SECTIONS_DIR), exist_ok=True)
+        days = [day_path for day_path in self.days if day_path.startswith(year + "/")]
+        write_text(self.section_name(year),
+                   render_template('geojson_root_year.html', year=year, year_val=year_table(days)))
+
+    def render_root(self, fn=INDEX_HTML):
+        # Root index.html from the sections of all years, sections missing on disk are rendered first
+        sections = []
+        for year in self.years():
+            if not os.path.exists(self.section_name(year)):
+                self.render_year(year)
+            with open(self.section_name(year), encoding='utf-8') as f:
+                sections.append(f.read())
+        write_text(os.path.join(self.root, fn), render_template('geojson_root_index.html', sections=sections))
+
+    def render_all(self, fn=INDEX_HTML):
+        for year in self.years():
+            self.render_year(year)
+        self.render_root(fn)
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Metrics of a collector run: counters, gauges and histograms with labels.
+# Written as a JSON file per run and as a Prometheus textfile (for the textfile collector of node_exporter), e.g.
+#   metrics/metobs_2020062114.json
+#   metrics/metobs.prom
+#
+# metrics = Metrics()
+# metrics.define("metobs_request_seconds", "histogram", "Latency of requests", buckets=LATENCY_BUCKETS)
+# metrics.observe("metobs_request_seconds", 0.12, hop="station")
+# with metrics.timer("metobs_store_seconds", resource="01"):
+#     ...
+#
+
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+from metobs_files import write_text
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Seconds
+PROM_FILE = "metobs.prom"
+
+
+def label_str(labels):
+    # {'hop': "station"} -> '{hop="station"}', labels is a tuple of (name, value) pairs
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join("{}=\"{}\"".format(k, v) for (k, _), v in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name: {'type': "counter" | "gauge" | "histogram", 'help': "...", 'buckets': (...), 'values': {labels: value}}
+        # labels is a sorted tuple of (name, value) pairs, the value of a histogram is
+        # {'buckets': [count per bucket], 'sum': ..., 'count': ...}
+        self.metrics = {}
+
+    def define(self, name, kind, help_text, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = {'type': kind, 'help': help_text, 'buckets': tuple(buckets), 'values': {}}
+
+    def _values(self, name, kind):
+        if name not in self.metrics:
+            self.metrics[name] = {'type': kind, 'help': name, 'buckets': LATENCY_BUCKETS, 'values': {}}
+        return self.metrics[name]['values']
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            values = self._values(name, "counter")
+            key = tuple(sorted(labels.items()))
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self._values(name, "gauge")[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            values = self._values(name, "histogram")
+            buckets = self.metrics[name]['buckets']
+            key = tuple(sorted(labels.items()))
+            if key not in values:
+                values[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            h = values[key]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h['buckets'][i] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # Observe the seconds of the block in the histogram name, or set the gauge name
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            if name in self.metrics and self.metrics[name]['type'] == "gauge":
+                self.set(name, elapsed, **labels)
+            else:
+                self.observe(name, elapsed, **labels)
+
+    def to_json(self):
+        # {name: {'type': ..., 'help': ..., 'values': [{'labels': {...}, 'value': ...}, ...]}}, a histogram value is
+        # {'buckets': {"0.05": cumulative count, ...}, 'sum': ..., 'count': ...}
+        with self.lock:
+            res = {}
+            for name, m in sorted(self.metrics.items()):
+                values = []
+                for labels, v in sorted(m['values'].items()):
+                    if m['type'] == "histogram":
+                        v = {'buckets': {str(le): n for le, n in zip(m['buckets'], v['buckets'])},
+                             'sum': v['sum'], 'count': v['count']}
+                    values.append({'labels': dict(labels), 'value': v})
+                res[name] = {'type': m['type'], 'help': m['help'], 'values': values}
+            return res
+
+    def to_prometheus(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name, m in sorted(self.metrics.items()):
+                lines.append("# HELP {} {}".format(name, m['help']))
+                lines.append("# TYPE {} {}".format(name, m['type']))
+                for labels, v in sorted(m['values'].items()):
+                    if m['type'] == "histogram":
+                        for le, n in zip(m['buckets'], v['buckets']):
+                            lines.append("{}_bucket{} {}".format(name, label_str(labels + (('le', le),)), n))
+                        lines.append("{}_bucket{} {}".format(name, label_str(labels + (('le', "+Inf"),)), v['count']))
+                        lines.append("{}_sum{} {}".format(name, label_str(labels), v['sum']))
+                        lines.append("{}_count{} {}".format(name, label_str(labels), v['count']))
+                    else:
+                        lines.append("{}{} {}".format(name, label_str(labels), v))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, run_id):
+        # Write path/metobs_<run_id>.json and path/metobs.prom, returns the name of the JSON file
+        os.makedirs(path, exist_ok=True)
+        fn = os.path.join(path, "metobs_{}.json".format(run_id))
+        write_text(fn, json.dumps({'run_id': run_id,
+                                   'generated': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                   'metrics': self.to_json()}, ensure_ascii=False, indent=1))
+        write_text(os.path.join(path, PROM_FILE), self.to_prometheus())
+        return fn
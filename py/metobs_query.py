@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# In-memory index of one collected resource (a day file, e.g. "01_Lufttemperatur__max_1_gång_per_tim.geojson") for
+# the query endpoints of emitter_metobs.py. The features are kept as loaded, with columns of metobs_columnar for
+# filtering and a grid of the station coordinates for spatial queries.
+#
+# index = ResourceIndex(features)
+# rows = index.bbox(11.0, 55.0, 14.5, 56.5)        # Row numbers, in the order of the features
+# rows = index.radius(13.19, 55.70, 50.0)          # Within 50 km
+# rows = index.stations(["Lund"], rows)
+# rows = index.since(1593698400000)                # Updated after the watermark, ms since epoch
+# fc = index.feature_collection(rows)
+#
+# Resources joined on station id, one row per station and one column of values per resource:
+# joined = join({"03": index_03, "04": index_04})
+#
+
+import math
+import numpy as np
+import metobs_columnar
+
+GRID_SIZE = 0.5        # Degrees, side of a cell of the grid
+EARTH_RADIUS = 6371.0  # km
+
+
+class ResourceIndex:
+    def __init__(self, features):
+        self.features = features
+        self.cols = metobs_columnar.from_features(features)
+        self.names = self.cols['station_ids'][self.cols['station']]  # Station name per row
+        # Grid of rows, {(i, j): array of row numbers}, i and j are the cell of lon and lat
+        self.grid = {}
+        cells = np.stack([np.floor(self.cols['lon'] / GRID_SIZE), np.floor(self.cols['lat'] / GRID_SIZE)], axis=1)
+        for row, (i, j) in enumerate(cells.astype(np.int64).tolist()):
+            self.grid.setdefault((i, j), []).append(row)
+        self.grid = {cell: np.array(rows, dtype=np.int64) for cell, rows in self.grid.items()}
+        # Rows sorted by 'updated', for the rows updated after a watermark
+        self.by_updated = np.argsort(self.cols['updated'], kind='stable')
+        self.updated_sorted = self.cols['updated'][self.by_updated]
+
+    def __len__(self):
+        return len(self.features)
+
+    def all(self):
+        return np.arange(len(self.features))
+
+    def _cells(self, min_lon, min_lat, max_lon, max_lat):
+        # Rows of all cells overlapping the box, a superset of the rows within the box. The box is clamped to valid
+        # coordinates, e.g. the margins of radius near the poles
+        min_lon, max_lon = max(min_lon, -180.0), min(max_lon, 180.0)
+        min_lat, max_lat = max(min_lat, -90.0), min(max_lat, 90.0)
+        if min_lon > max_lon or min_lat > max_lat:
+            return np.empty(0, dtype=np.int64)
+        i0, i1 = math.floor(min_lon / GRID_SIZE), math.floor(max_lon / GRID_SIZE)
+        j0, j1 = math.floor(min_lat / GRID_SIZE), math.floor(max_lat / GRID_SIZE)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.grid):
+            cells = [cell for cell in self.grid if i0 <= cell[0] <= i1 and j0 <= cell[1] <= j1]
+        else:
+            cells = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1) if (i, j) in self.grid]
+        return np.sort(np.concatenate([self.grid[cell] for cell in cells])) if cells else np.empty(0, dtype=np.int64)
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat):
+        rows = self._cells(min_lon, min_lat, max_lon, max_lat)
+        lon, lat = self.cols['lon'][rows], self.cols['lat'][rows]
+        return rows[(lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)]
+
+    def radius(self, lon, lat, km):
+        # Rows within km of (lon, lat), great circle distance, sorted by row number
+        dlat = math.degrees(km / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        rows = self._cells(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+        return rows[self.distance(rows, lon, lat) <= km]
+
+    def distance(self, rows, lon, lat):
+        # Great circle distance in km from (lon, lat) to the stations of rows
+        lon1, lat1 = np.radians(self.cols['lon'][rows]), np.radians(self.cols['lat'][rows])
+        lon2, lat2 = math.radians(lon), math.radians(lat)
+        a = np.sin((lat1 - lat2) / 2) ** 2 + np.cos(lat1) * math.cos(lat2) * np.sin((lon1 - lon2) / 2) ** 2
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    def since(self, watermark):
+        # Rows updated after watermark (ms since epoch), sorted by row number
+        return np.sort(self.by_updated[np.searchsorted(self.updated_sorted, watermark, side='right'):])
+
+    def watermark(self):
+        # The latest 'updated' of the resource, None if it has no features
+        return int(self.updated_sorted[-1]) if len(self.updated_sorted) else None
+
+    def stations(self, names, rows=None):
+        # Rows of the stations in names (feature ids)
+        rows = self.all() if rows is None else rows
+        return rows[np.isin(self.names[rows], list(names))]
+
+    def feature_collection(self, rows):
+        return {"type": "FeatureCollection", "features": [self.features[row] for row in rows.tolist()]}
+
+    def compact(self, rows):
+        # Column oriented, {'station': [...], 'lon': [...], 'lat': [...], 'height': [...], 'updated': [...],
+        # 'value': [...]}. A value that is not a number is given as text, None for an unknown height
+        value = [t if t else v for v, t in zip(self.cols['value'][rows].tolist(), self.cols['text'][rows].tolist())]
+        height = [None if math.isnan(h) else h for h in self.cols['height'][rows].tolist()]
+        return {'station': self.names[rows].tolist(),
+                'lon': self.cols['lon'][rows].tolist(),
+                'lat': self.cols['lat'][rows].tolist(),
+                'height': height,
+                'updated': self.cols['updated'][rows].tolist(),
+                'value': value}
+
+    def value(self, row):
+        # Value of row, the text if it is not a number
+        return str(self.cols['text'][row]) if self.cols['text'][row] else float(self.cols['value'][row])
+
+
+def join(indexes, how="inner"):
+    # Join resources on station id, indexes is {key: ResourceIndex}. how is "inner", stations of all resources, or
+    # "outer", stations of any resource (None for a missing value). Returns
+    # {'keys': [keys], 'station': [...], 'lon': [...], 'lat': [...], 'values': {key: [values in station order]}}
+    # The position of a station is taken from the first resource (in the order of indexes) that has it
+    rows = {}  # key: {station name: row}
+    stations = None
+    for key, res in indexes.items():
+        rows[key] = {name: row for row, name in reversed(list(enumerate(res.names.tolist())))}  # First row of a name
+        names = set(rows[key])
+        stations = names if stations is None else stations & names if how == "inner" else stations | names
+    stations = sorted(stations or [])
+
+    lon = []
+    lat = []
+    for name in stations:
+        key = next(key for key in indexes if name in rows[key])
+        lon.append(float(indexes[key].cols['lon'][rows[key][name]]))
+        lat.append(float(indexes[key].cols['lat'][rows[key][name]]))
+    values = {key: [res.value(rows[key][name]) if name in rows[key] else None for name in stations]
+              for key, res in indexes.items()}
+    return {'keys': list(indexes), 'station': stations, 'lon': lon, 'lat': lat, 'values': values}
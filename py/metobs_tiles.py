@@ -0,0 +1,137 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+__author__ = 'mm'
+
+# Mapbox Vector Tiles (MVT, version 2) of the stations of one resource, for the tile endpoint of emitter_metobs.py.
+# The tile is one layer of points, named by the parameter key. At zoom levels below CLUSTER_MAX_ZOOM the stations are
+# thinned by clustering them in a grid of CLUSTER_CELL tile units: one point per cell at the mean position, with the
+# number of stations ('count') and the mean value. At higher zoom levels each station is a point with the properties
+# 'station', 'value', 'updated' and 'height'.
+#
+# The protobuf encoding is written here, only the messages and fields needed for points:
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+#
+# data = tile(index, "01", 6, 34, 18)   # index is a metobs_query.ResourceIndex, returns the encoded tile
+#
+
+import math
+import struct
+import numpy as np
+
+EXTENT = 4096          # Tile units per side
+BUFFER = 64            # Tile units around the tile, stations within the buffer are included (symbols at the border)
+CLUSTER_MAX_ZOOM = 7   # Zoom levels below this are clustered
+CLUSTER_CELL = 256     # Tile units, side of a cluster cell
+MAX_LAT = 85.0511287798  # Web Mercator
+
+
+def varint(n):
+    res = bytearray()
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            res.append(b | 0x80)
+        else:
+            res.append(b)
+            return bytes(res)
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def field(number, wire_type):
+    return varint((number << 3) | wire_type)
+
+
+def length_delimited(number, data):
+    return field(number, 2) + varint(len(data)) + data
+
+
+def packed(number, values):
+    return length_delimited(number, b"".join(varint(v) for v in values))
+
+
+def value_message(v):
+    # Layer.Value: string_value = 1, double_value = 3, sint_value = 6, bool_value = 7
+    if isinstance(v, bool):
+        return field(7, 0) + varint(int(v))
+    if isinstance(v, int):
+        return field(6, 0) + varint(zigzag(v))
+    if isinstance(v, float):
+        return field(3, 1) + struct.pack("<d", v)
+    return length_delimited(1, str(v).encode('utf-8'))
+
+
+def encode_layer(name, points, extent=EXTENT):
+    # points is a list of (id, tile x, tile y, {property: value}), returns an encoded Tile with one layer
+    keys = {}
+    values = {}
+    features = []
+    for fid, x, y, props in points:
+        tags = []
+        for k, v in props.items():
+            if v is None or (isinstance(v, float) and math.isnan(v)):
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault((type(v).__name__, v), len(values)))
+        geometry = [(1 & 0x7) | (1 << 3), zigzag(x), zigzag(y)]  # MoveTo, one point
+        features.append(field(1, 0) + varint(fid) + packed(2, tags) + field(3, 0) + varint(1) + packed(4, geometry))
+
+    layer = field(15, 0) + varint(2) + length_delimited(1, name.encode('utf-8'))
+    layer += b"".join(length_delimited(2, f) for f in features)
+    layer += b"".join(length_delimited(3, k.encode('utf-8')) for k in keys)
+    layer += b"".join(length_delimited(4, value_message(v)) for _, v in values)
+    layer += field(5, 0) + varint(extent)
+    return length_delimited(3, layer)
+
+
+def tile_bounds(z, x, y):
+    # (min lon, min lat, max lon, max lat) of tile z/x/y
+    n = 2 ** z
+
+    def lat(ty):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ty / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+
+def to_tile(lon, lat, z, x, y, extent=EXTENT):
+    # Tile units of the positions within tile z/x/y, arrays of lon and lat
+    n = 2 ** z
+    lat = np.radians(np.clip(lat, -MAX_LAT, MAX_LAT))
+    tx = (lon + 180.0) / 360.0 * n
+    ty = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * n
+    return np.round((tx - x) * extent).astype(np.int64), np.round((ty - y) * extent).astype(np.int64)
+
+
+def tile(index, key, z, x, y):
+    # The encoded tile z/x/y of the stations of index (metobs_query.ResourceIndex), layer named key
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+    margin_lon = (max_lon - min_lon) * BUFFER / EXTENT
+    margin_lat = (max_lat - min_lat) * BUFFER / EXTENT
+    rows = index.bbox(min_lon - margin_lon, min_lat - margin_lat, max_lon + margin_lon, max_lat + margin_lat)
+    tx, ty = to_tile(index.cols['lon'][rows], index.cols['lat'][rows], z, x, y)
+
+    points = []
+    if z < CLUSTER_MAX_ZOOM:
+        cells = {}
+        for i, (px, py) in enumerate(zip(tx.tolist(), ty.tolist())):
+            cells.setdefault((px // CLUSTER_CELL, py // CLUSTER_CELL), []).append(i)
+        for members in cells.values():
+            members = np.array(members)
+            values = index.cols['value'][rows[members]]
+            props = {'count': len(members),
+                     'value': float(np.nanmean(values)) if not np.all(np.isnan(values)) else None}
+            if len(members) == 1:
+                props['station'] = str(index.names[rows[members[0]]])
+            points.append((int(rows[members[0]]) + 1, int(round(tx[members].mean())), int(round(ty[members].mean())),
+                           props))
+    else:
+        for i, row in enumerate(rows.tolist()):
+            points.append((row + 1, int(tx[i]), int(ty[i]),
+                           {'station': str(index.names[row]), 'value': index.value(row),
+                            'updated': int(index.cols['updated'][row]), 'height': float(index.cols['height'][row])}))
+    return encode_layer(key, points)
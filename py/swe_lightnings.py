@@ -22,6 +22,7 @@ import warnings
 from flask import Flask, render_template
 import warnings
 from shapely.errors import ShapelyDeprecationWarning
+from metobs_http import get_client
 
 
 METOBS_DIR = "metobs_data"
@@ -199,7 +200,7 @@ class Lightnings:
                      day=self.latest_date['day'])
         print("Processing {}".format(url))
         try:
-            data = requests.get(url).json()
+            data = get_client().get_json(url)
         except requests.exceptions.RequestException as e:
             raise SystemExit(e)
 
@@ -12,21 +12,26 @@ import matplotlib.streamplot as splt
 import geopandas as gpd
 import numpy as np
 import os
+import io
 import sys
+import functools
 import cartopy.crs as ccrs
 from scipy.interpolate import griddata
 from flask import Flask, render_template
-import requests
 import datetime
 from uritemplate import expand
 import warnings
 from shapely.errors import ShapelyDeprecationWarning
+from metobs_http import get_client
+import metobs_columnar
 
 
 DELTA = 1
 DATA_DIR = "data"
 IMG_DIR = "img"
 METOBS_DIR = "metobs_data"
+METOBS_URL = "https://www.viltstigen.se/metobs/latest/"
+METOBS_BATCH_URL = "https://www.viltstigen.se/metobs/batch"
 
 app = Flask(__name__)
 
@@ -40,7 +45,7 @@ class Map:
         self.max_x = None
         self.max_y = None
 
-        r = requests.get("https://www.viltstigen.se/smhi_metobs/latest/meta.json").json()
+        r = get_client().get_json("https://www.viltstigen.se/smhi_metobs/latest/meta.json")
         self.title = r['generated']
 
         self.fig = plt.figure(figsize=(8, 6))
@@ -123,6 +128,39 @@ class Map:
         self.zorder += 1
 
 
+@functools.lru_cache(maxsize=None)
+def read_metobs(key):
+    # Latest observations of resource key ("01" etc.) from the emitter, using the shared pooled client
+    # The columnar companion file is loaded if it exists, otherwise the GeoJSON file. Each key is read once per run
+    r = get_client().get(METOBS_URL + key + "*" + metobs_columnar.EXT)
+    if r.status_code != 200:
+        return gpd.GeoDataFrame.from_features(get_client().get_json(METOBS_URL + key + "*"), crs="EPSG:4326")
+
+    columns = metobs_columnar.load(io.BytesIO(r.content))
+    return gpd.GeoDataFrame({'id': columns['station_ids'][columns['station']],
+                             'height': columns['height'],
+                             'updated': columns['updated'],
+                             'value': columns['value']},
+                            geometry=gpd.points_from_xy(columns['lon'], columns['lat']),
+                            crs="EPSG:4326")
+
+
+def read_joined(key_1, key_2):
+    # Stations with latest observations of both resources, joined on station id by the emitter (batch endpoint).
+    # Columns 'value_1' and 'value_2' are the values of key_1 and key_2
+    r = get_client().get(METOBS_BATCH_URL + "?key=" + key_1 + "," + key_2)
+    if r.status_code != 200:
+        # Emitter without the batch endpoint, join on the position of the stations
+        return gpd.overlay(read_metobs(key_1), read_metobs(key_2), how='intersection')
+
+    joined = r.json()
+    return gpd.GeoDataFrame({'id': joined['station'],
+                             'value_1': joined['values'][key_1],
+                             'value_2': joined['values'][key_2]},
+                            geometry=gpd.points_from_xy(joined['lon'], joined['lat']),
+                            crs="EPSG:4326")
+
+
 # Having this Python script working with all libraries compiled and with right versions is a nightmare...
 # Currently, it works, but with warnings from Shapely. There for I am suppressing these warnings.
 # See https://gis.stackexchange.com/questions/420046/shapely-deprecation-warning-message-when-plotting-geopandas-geodataframe
@@ -142,26 +180,26 @@ if __name__ == "__main__":
             mp = Map()
 
             if img == 'Temp':
-                obs_data = gpd.read_file("https://www.viltstigen.se/metobs/latest/01*")
+                obs_data = read_metobs("01")
                 cmap = 'coolwarm'
                 title = 'Temperature latest hour'
                 fname = 'temp.svg'
                 fn = os.path.join(METOBS_DIR, IMG_DIR, fname)
                 annotations.append("Min temp {}, Max temp {}".format(min(obs_data['value']), max(obs_data['value'])))
             elif img in ['Rain', 'Lightning']:
-                obs_data = gpd.read_file("https://www.viltstigen.se/metobs/latest/07*")
+                obs_data = read_metobs("07")
                 cmap = 'Blues'
 
                 fname = 'rain.svg' if img == 'Rain' else 'lightning.svg'
                 fn = os.path.join(METOBS_DIR, IMG_DIR, fname)
 
                 dt = datetime.datetime.now() - datetime.timedelta(1)  # Get yesterday date
-                lightning_data = requests.get(
+                lightning_data = get_client().get_json(
                     expand('https://opendata-download-lightning.smhi.se/api/version/latest/'
                            'year/{year}/month/{month}/day/{day}/data.json',
                            year=dt.strftime("%Y"),
                            month=dt.strftime("%m"),
-                           day=dt.strftime("%d"))).json()
+                           day=dt.strftime("%d")))
 
                 lightnings = {'lat': [], 'lon': [], 'peakCurrent': []}
                 no_lightnings = 0
@@ -176,23 +214,21 @@ if __name__ == "__main__":
                 annotations.append("Nr of lightnings {}".format(no_lightnings)) if img == 'Lightning' else \
                     annotations.append("Max rain {}".format(max(obs_data['value'])))
             elif img == 'Pressure':
-                obs_data = gpd.read_file("https://www.viltstigen.se/metobs/latest/09*")
+                obs_data = read_metobs("09")
                 cmap = 'coolwarm'
                 title = 'Air pressure lastest hour'
                 fname = 'pressure.svg'
                 fn = os.path.join(METOBS_DIR, IMG_DIR, fname)
             elif img in ['Wind', 'Quiver']:
-                obs_data = gpd.read_file("https://www.viltstigen.se/metobs/latest/09*")
-                wind_directions = gpd.read_file("https://www.viltstigen.se/metobs/latest/03*")
-                wind_speeds = gpd.read_file("https://www.viltstigen.se/metobs/latest/04*")
-                wind_stations = gpd.overlay(wind_directions, wind_speeds, how='intersection')
+                obs_data = read_metobs("09")
+                wind_stations = read_joined("03", "04")
                 cmap = 'coolwarm'
                 title = 'Wind streams and air pressure' if img == 'Wind' else "Wind direction and strengths"
                 title += ' latest hour'
                 fname = 'winds.svg' if img == 'Wind' else "wind_quiver.svg"
                 fn = os.path.join(METOBS_DIR, IMG_DIR, fname)
                 if img == 'Wind':
-                    annotations.append("Max wind {}m/s".format(max(wind_speeds['value'])))
+                    annotations.append("Max wind {}m/s".format(max(wind_stations['value_2'])))
 
             geom = mp.new_geometry('SWE')
 